@@ -6,6 +6,9 @@ neuroradiological reports using the
 neuroNLP package.
 """
 
+import os
+import time
+import uuid
 from datetime import date
 
 import matplotlib.pyplot as plt
@@ -15,46 +18,57 @@ import streamlit as st
 from neuradicon.custom_pipes import (DomainDetector, NegationDetector,
                                      RelationExtractor, SpacySectioner)
 
+from neurodash.cache import DecryptCache
 from neurodash.clinical import *
+from neurodash.domains import expand_domain_columns
+from neurodash.inference import DEFAULT_MODEL_PATHS, MAX_ENRICHED_REPORTS
+from neurodash.jobs import InferenceJobQueue
 from neurodash.operational import *
+from neurodash.sections import expand_section_columns
 from neurodash.service_analysis import *
 from neurodash.utils import *
 
-SPACY_INFO_MODEL = "./models/en_neuro_base-1.0/en_neuro_base/en_neuro_base-1.0"
-SPACY_NORMAL_MODEL = "./models/en_tok2vec_binary_norm_v2-2.0.0/en_tok2vec_binary_norm_v2/en_tok2vec_binary_norm_v2-2.0.0"
-SPACY_COMPARATIVE_MODEL = "./models/en_comp_cls-1.0/en_comp_cls/en_comp_cls-1.0"
-SPACY_TOKENIZER = "./models/en_core_web_sm/en_core_web_sm-3.0.0"
-SPACY_SECTIONER_PATH = "./models/en_tok2vec_section_cls-1.0/en_tok2vec_section_cls/en_tok2vec_section_cls-1.0"
-SPACY_DOMAINER_PATH = "./models/pathology_patterns_v4"
+INFERENCE_CACHE_PATH = "./dashboard_assets/inference_cache.sqlite"
+DOC_STORE_PATH = "./dashboard_assets/doc_store.sqlite"
+N_INFERENCE_WORKERS = int(os.environ.get("NEURODASH_INFERENCE_WORKERS", 1))
+MAX_ENRICHED_REPORTS = int(
+    os.environ.get("NEURODASH_MAX_ENRICHED_REPORTS", MAX_ENRICHED_REPORTS)
+)
+INFERENCE_CHUNK_SIZE = 5000
+JOB_POLL_SECONDS = 1
 
 DATA_FORMAT = srsly.read_json("./dashboard_assets/dashboard_config.json")
 
 
-inference_models = {
-    "comparative_cls": SPACY_COMPARATIVE_MODEL,
-    "section_cls": SPACY_SECTIONER_PATH,
-    "normality_cls": SPACY_NORMAL_MODEL,
-    "info_model": SPACY_INFO_MODEL,
-    "domainer": SPACY_DOMAINER_PATH,
-    "tokenizer": SPACY_TOKENIZER,
-}
+inference_models = DEFAULT_MODEL_PATHS
 
 st.set_page_config(layout="wide")
 sidebar_title = "neuroNLP Dashboard"
 sidebar_description = "A tool for interpreting neuroradiological reports"
-inference_engine = model_factory(inference_models)
+inference_engine = model_factory(
+    inference_models,
+    cache_path=INFERENCE_CACHE_PATH,
+    n_workers=N_INFERENCE_WORKERS,
+    contrast_markers=DATA_FORMAT["uses_contrast"].get("contrast_markers"),
+    doc_store_path=DOC_STORE_PATH,
+    max_enriched_reports=MAX_ENRICHED_REPORTS,
+)
 st.sidebar.title(sidebar_title)
 st.sidebar.markdown(sidebar_description)
 viewer = st.sidebar.selectbox(
     "Select view", ("Operational", "Clinical", "Workload Analysis")
 )
+show_inference_stats = st.sidebar.checkbox("Show inference statistics")
 
 
 ENCRYPTION_CHECKED = False
 UPLOAD_COMPLETE = False
+INFERENCE_PENDING = False
 st.title("Operational Analysis Dashboard")
 uploaded_files = st.file_uploader(
-    "Upload CSV/XLSX", accept_multiple_files=True, type=["csv", "xlsx"]
+    "Upload CSV/XLSX or enriched Parquet",
+    accept_multiple_files=True,
+    type=["csv", "xlsx", "parquet"],
 )
 
 
@@ -62,41 +76,102 @@ filenames = get_filenames(uploaded_files)
 uploaded_files = list(zip(filenames, uploaded_files))
 
 
-@st.cache_data
-def _get_report_df(list_of_files, data_format):
-    report_dfs = read_file_input(list_of_files, data_format)
-    report_df = pd.concat(report_dfs, ignore_index=True)
-    inferred_cols = [key for key, vals in data_format.items() if vals["inferred"]]
-    report_df = inference_engine.infer_addition_report_data(
-        report_df, infer_data=inferred_cols, batch_size=128, n_processes=1
+@st.cache_resource
+def _inference_job_queue(_inference_engine):
+    """One background job queue shared by every dashboard session"""
+    return InferenceJobQueue(_inference_engine, chunk_size=INFERENCE_CHUNK_SIZE)
+
+
+job_queue = _inference_job_queue(inference_engine)
+
+
+@st.cache_resource
+def _decrypt_cache():
+    """Decrypted uploads shared by every dashboard session"""
+    return DecryptCache()
+
+
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+
+
+def _upload_key(list_of_files):
+    """Identify an upload without hashing the file contents"""
+    return tuple(
+        (name, getattr(f, "file_id", None), len(f.getbuffer()))
+        for name, f in list_of_files
     )
-    return report_df
 
 
 @st.cache_data
 def _prepare_data_for_workload(data):
-    new_data = data.drop(columns=["pathological_domains"])
-    new_data = transform_data(new_data)
+    new_data = transform_data(data)
     return new_data
 
 
 if uploaded_files:
+    upload_key = _upload_key(uploaded_files)
+
+# Once a job has been submitted for this upload its thread is reading the
+# uploaded files, so reruns must not seek or read them again to probe them
+if uploaded_files and st.session_state.get("upload_key") == upload_key:
+    ENCRYPTION_CHECKED = True
+elif uploaded_files:
     encryption_list = check_file_encryption(uploaded_files)
     if any(encryption_list):
         password = st.text_input(
             "One or more files are password protected, please supply password"
         )
         if password:
-            uploaded_files = decrypt_files(uploaded_files, encryption_list, password)
-            ENCRYPTION_CHECKED = True
+            try:
+                uploaded_files = decrypt_files(
+                    uploaded_files, encryption_list, password, _decrypt_cache()
+                )
+                ENCRYPTION_CHECKED = True
+            except Exception as e:
+                st.error(str(e))
     else:
         ENCRYPTION_CHECKED = True
 
 
 if ENCRYPTION_CHECKED:
-    report_df = _get_report_df(uploaded_files, DATA_FORMAT)
-    # workload_data = _prepare_data_for_workload(report_df)
-    UPLOAD_COMPLETE = True
+    if st.session_state.get("upload_key") != upload_key:
+        st.session_state["job_id"] = job_queue.submit(
+            st.session_state["session_id"], uploaded_files, DATA_FORMAT
+        )
+        st.session_state["upload_key"] = upload_key
+        st.session_state.pop("report_df", None)
+    if "report_df" not in st.session_state:
+        job = job_queue.get(st.session_state["job_id"])
+        if job is None:
+            st.error("Inference job expired, please upload the files again")
+            st.session_state.pop("upload_key")
+        elif job.status == "done":
+            st.session_state["inference_stats"] = job.stage_stats
+            st.session_state["report_df"] = job_queue.pop_result(job.id)
+        elif job.status == "failed":
+            st.error("Inference failed for the uploaded files")
+            st.code(job.error)
+        else:
+            inference_progress_display(
+                list(job.chunks),
+                job.n_total,
+                job.elapsed_seconds,
+                show_summary=viewer == "Operational",
+            )
+            st.session_state["inference_stats"] = job.stage_stats
+            INFERENCE_PENDING = True
+    if "report_df" in st.session_state:
+        report_df = st.session_state["report_df"]
+        # workload_data = _prepare_data_for_workload(report_df)
+        UPLOAD_COMPLETE = True
+
+
+if show_inference_stats:
+    inference_stats_display(
+        st.session_state.get("inference_stats", {}),
+        inference_engine.model_load_report(),
+    )
 
 
 def select_dates(frame, min_date, max_date):
@@ -129,7 +204,7 @@ if viewer == "Operational":
         st.download_button(
             label="Export analysis as pdf", data=buffer, file_name="analysis_report.pdf"
         )
-        csv = convert_df(report_subset)
+        csv = convert_df(expand_section_columns(expand_domain_columns(report_subset)))
         st.download_button(
             label="Export selection as csv",
             data=csv,
@@ -160,7 +235,7 @@ elif viewer == "Clinical":
         if report_row is not None:
             EXAMPLE_REPORT = report_row["Narrative"]
             if len(EXAMPLE_REPORT) > 5:
-                doc = inference_engine.nlp(EXAMPLE_REPORT)
+                doc = inference_engine.parse_report(EXAMPLE_REPORT)
                 clinical_display(report_row, doc)
             else:
                 st.text("No report narrative present")
@@ -212,3 +287,7 @@ elif viewer == "Workload Analysis":
                     data=buf,
                     file_name=f"reporter_{i}_analysis.pdf",
                 )
+
+if INFERENCE_PENDING:
+    time.sleep(JOB_POLL_SECONDS)
+    st.rerun()
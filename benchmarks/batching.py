@@ -0,0 +1,88 @@
+"""Benchmark length-bucketed batching for spacy pipelines
+
+Compares docs/sec for upload-order batching, length-sorted batching and
+token-budgeted batching on narratives with a long-tailed length
+distribution, using a small stand-in text classification pipeline.
+
+Usage: python benchmarks/batching.py --n-docs 5000
+"""
+
+import argparse
+import random
+import time
+
+import numpy as np
+import spacy
+from spacy.training import Example
+
+from neurodash import inference
+
+VOCABULARY = (
+    "no intracranial abnormality is seen there is a small focus of signal change "
+    "in the left frontal white matter consistent with small vessel disease the "
+    "ventricles and sulci are normal for age post gadolinium enhancement"
+).split()
+
+
+def synthetic_narratives(n_docs, seed=0):
+    """Narratives of 5 to 4000 words with a log-normal length distribution"""
+    rng = np.random.default_rng(seed)
+    word_rng = random.Random(seed)
+    lengths = np.clip(rng.lognormal(mean=4.5, sigma=1.0, size=n_docs), 5, 4000)
+    return [
+        " ".join(word_rng.choices(VOCABULARY, k=int(n_words))) for n_words in lengths
+    ]
+
+
+def stand_in_pipeline():
+    """Blank English pipeline with an initialised tok2vec text classifier"""
+    nlp = spacy.blank("en")
+    textcat = nlp.add_pipe("textcat")
+    for label in ["NORMAL", "ABNORMAL"]:
+        textcat.add_label(label)
+    examples = [
+        Example.from_dict(nlp.make_doc(t), {"cats": {"NORMAL": 1.0, "ABNORMAL": 0.0}})
+        for t in synthetic_narratives(8)
+    ]
+    nlp.initialize(lambda: examples)
+    return nlp
+
+
+def time_docs(docs):
+    start = time.perf_counter()
+    n_docs = sum(1 for _ in docs)
+    return n_docs / (time.perf_counter() - start)
+
+
+def run(n_docs, batch_size, max_batch_tokens):
+    nlp = stand_in_pipeline()
+    texts = synthetic_narratives(n_docs)
+    lengths = inference.text_lengths(texts)
+    sorted_texts = [texts[i] for i in np.argsort(lengths, kind="stable")]
+    budget_sizes = inference.token_budget_batch_sizes(
+        np.sort(lengths, kind="stable"), batch_size, max_batch_tokens
+    )
+    results = {
+        "upload order": time_docs(nlp.pipe(texts, batch_size=batch_size)),
+        "length sorted": time_docs(nlp.pipe(sorted_texts, batch_size=batch_size)),
+        f"length sorted, {max_batch_tokens} token batches": time_docs(
+            inference.pipe_batches(nlp, sorted_texts, budget_sizes)
+        ),
+    }
+    print(f"{n_docs} docs, median length {int(np.median(lengths))} words")
+    for name, docs_per_sec in results.items():
+        print(f"{name:<45}{docs_per_sec:>10.1f} docs/sec")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n-docs", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--max-batch-tokens", type=int, default=8192)
+    args = parser.parse_args()
+    run(args.n_docs, args.batch_size, args.max_batch_tokens)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Time the narrative cleaning engine on synthetic RIS narratives
+
+That it agrees with the original cleaning rules is checked by
+tests/test_cleaning.py.
+
+Usage: python benchmarks/cleaning.py --n-reports 100000 --workers 4
+"""
+
+import argparse
+import time
+
+import srsly
+from synthetic import synthetic_ris_df
+
+from neurodash.cleaning import clean_narratives
+
+DEFAULT_CONFIG_PATH = "./dashboard_assets/dashboard_config.json"
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--n-reports", type=int, default=20000)
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    narratives = synthetic_ris_df(
+        args.n_reports, srsly.read_json(args.config), args.seed
+    )["Narrative"]
+    _, seconds = timed(clean_narratives, narratives)
+    print(f"fused engine: {len(narratives) / seconds:,.0f} docs/sec")
+    if args.workers > 1:
+        _, parallel_seconds = timed(clean_narratives, narratives, args.workers)
+        print(
+            f"fused engine, {args.workers} workers: "
+            f"{len(narratives) / parallel_seconds:,.0f} docs/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Benchmark ingest and inference throughput of neuroDash
+
+Generates synthetic RIS exports matching the dashboard config at several
+sizes, times `read_file_input`/`process_ris_df` and each stage of
+`DashboardInferenceEngine.infer_addition_report_data`, and writes the
+per-stage throughput to a JSON file. Pass an earlier results file with
+--compare to see the change in docs/sec for every size and stage.
+
+Stand-in pipelines are used unless real models are given with --models,
+in which case the sections and pathological domains stages are included.
+
+Usage: python benchmarks/inference.py --sizes 1000 10000 --output results.json
+"""
+
+import argparse
+import io
+import platform
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import pandas as pd
+import spacy
+import srsly
+from synthetic import stand_in_models, synthetic_ris_df
+
+from neurodash import inference
+from neurodash.utils import process_ris_df, read_file_input
+
+DEFAULT_CONFIG_PATH = "./dashboard_assets/dashboard_config.json"
+STAND_IN_COLUMNS = [
+    "uses_contrast",
+    "normality_class",
+    "is_comparative",
+    "report_length_words",
+]
+WARMUP_REPORTS = 64
+
+
+def benchmark_ingest(raw_df, data_format, stats):
+    """Time reading a CSV export and cleaning it with `process_ris_df`"""
+    n_tokens = inference.text_lengths(raw_df["Narrative"]).sum()
+    csv = raw_df.to_csv(index=False).encode("utf-8")
+    start = time.perf_counter()
+    report_df = read_file_input([("export.csv", io.BytesIO(csv))], data_format)[0]
+    inference.record_stage_stats(
+        stats, "read_file_input", time.perf_counter() - start, len(raw_df), n_tokens, 1
+    )
+    start = time.perf_counter()
+    process_ris_df(raw_df.copy(), data_format)
+    inference.record_stage_stats(
+        stats, "process_ris_df", time.perf_counter() - start, len(raw_df), n_tokens, 1
+    )
+    return report_df
+
+
+def run(sizes, data_format, model_paths, infer_data, batch_size, engine_kwargs, seed):
+    engine = inference.DashboardInferenceEngine(model_paths, **engine_kwargs)
+    results = {}
+    try:
+        warmup_df = read_file_input(
+            [
+                (
+                    "warmup.csv",
+                    io.BytesIO(
+                        synthetic_ris_df(WARMUP_REPORTS, data_format, seed + 1)
+                        .to_csv(index=False)
+                        .encode("utf-8")
+                    ),
+                )
+            ],
+            data_format,
+        )[0]
+        engine.infer_addition_report_data(
+            warmup_df, infer_data=infer_data, batch_size=batch_size
+        )
+        for n_reports in sizes:
+            stats = {}
+            raw_df = synthetic_ris_df(n_reports, data_format, seed)
+            report_df = benchmark_ingest(raw_df, data_format, stats)
+            _, inference_stats = engine.infer_addition_report_data(
+                report_df,
+                infer_data=infer_data,
+                batch_size=batch_size,
+                return_stats=True,
+            )
+            stats.update(inference_stats)
+            report = inference.stage_stats_report(stats)
+            print(f"\n{n_reports} reports")
+            print(report.round(2).to_string())
+            results[str(n_reports)] = report.to_dict(orient="index")
+    finally:
+        engine.close()
+    return results
+
+
+def compare(results, baseline):
+    """Print the change in docs/sec from a baseline results file"""
+    rows = []
+    for size, stages in results.items():
+        for stage, stats in stages.items():
+            previous = baseline["results"].get(size, {}).get(stage)
+            if previous is None:
+                continue
+            rows.append(
+                {
+                    "n_reports": size,
+                    "stage": stage,
+                    "baseline_docs_per_second": previous["docs_per_second"],
+                    "docs_per_second": stats["docs_per_second"],
+                    "change_%": 100
+                    * (stats["docs_per_second"] / previous["docs_per_second"] - 1),
+                }
+            )
+    print(f"\ncompared with {baseline['meta']['timestamp']}")
+    print(pd.DataFrame(rows).round(1).to_string(index=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--config", default=DEFAULT_CONFIG_PATH)
+    parser.add_argument(
+        "--models",
+        default=None,
+        help="JSON file mapping model names to paths, defaults to stand-in pipelines",
+    )
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-batch-tokens", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="earlier results JSON file")
+    args = parser.parse_args()
+
+    data_format = srsly.read_json(args.config)
+    engine_kwargs = {
+        "n_workers": args.workers,
+        "max_batch_tokens": args.max_batch_tokens,
+        "contrast_markers": data_format["uses_contrast"].get("contrast_markers"),
+    }
+    with tempfile.TemporaryDirectory() as model_dir:
+        if args.models:
+            model_paths, infer_data = (
+                srsly.read_json(args.models),
+                inference.INFERRED_COLUMNS,
+            )
+        else:
+            model_paths, infer_data = stand_in_models(Path(model_dir)), STAND_IN_COLUMNS
+        results = run(
+            args.sizes,
+            data_format,
+            model_paths,
+            infer_data,
+            args.batch_size,
+            engine_kwargs,
+            args.seed,
+        )
+
+    output = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "spacy": spacy.__version__,
+            "pandas": pd.__version__,
+            "models": "stand-in" if args.models is None else model_paths,
+            "batch_size": args.batch_size,
+            "n_workers": args.workers,
+            "max_batch_tokens": args.max_batch_tokens,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    srsly.write_json(args.output, output)
+    print(f"\nwrote results to {args.output}")
+    if args.compare:
+        compare(results, srsly.read_json(args.compare))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Synthetic RIS exports and stand-in models for benchmarking neuroDash
+
+Reports follow the columns and dtypes of `dashboard_config.json`, with
+narratives carrying the RTF fragments, line breaks and escape artefacts
+that `process_ris_df` cleans. The stand-in spacy pipelines have the
+labels and components the inference engine reads, but no trained
+weights worth the name, so benchmarks run without the production models.
+"""
+
+import random
+
+import numpy as np
+import pandas as pd
+import spacy
+from spacy.training import Example
+
+NARRATIVE_VOCABULARY = (
+    "no intracranial abnormality is seen there is a small focus of signal change "
+    "in the left right frontal parietal temporal white matter consistent with "
+    "small vessel disease the ventricles and sulci are normal for age comparison "
+    "is made with the previous study appearances are unchanged post gadolinium "
+    "enhancement of the lesion mass effect midline shift haemorrhage infarct"
+).split()
+NARRATIVE_ARTEFACTS = [
+    "{\\rtf1\\ansi {\\fonttbl\\f0 Arial;}",
+    "\\par",
+    "_x000D_",
+    "\n",
+    "\r\n",
+    "\n\n",
+    " .",
+    "  ",
+]
+STOCK_NARRATIVES = [
+    "No intracranial abnormality.",
+    "Normal MRI head for age.",
+    "Appearances are unchanged from the previous study.",
+]
+PROCEDURES = ["MR Head", "MR Head +C", "MRI Brain Post Gad", "CT Head", "MR Spine"]
+CLINICIANS = [f"Dr {name}" for name in "ABCDEFGHIJ"]
+
+
+def synthetic_narrative(rng, n_words):
+    words = rng.choices(NARRATIVE_VOCABULARY, k=n_words)
+    for _ in range(max(n_words // 15, 1)):
+        words.insert(rng.randrange(len(words) + 1), rng.choice(NARRATIVE_ARTEFACTS))
+    return "{\\rtf1 " + " ".join(words) + " }"
+
+
+def synthetic_column(name, spec, n_reports, rng, np_rng):
+    """Values for one non-inferred config column"""
+    if name == "Narrative":
+        lengths = np.clip(
+            np_rng.lognormal(mean=4.5, sigma=1.0, size=n_reports), 5, 4000
+        )
+        return [
+            (
+                rng.choice(STOCK_NARRATIVES)
+                if rng.random() < 0.15
+                else synthetic_narrative(rng, int(n_words))
+            )
+            for n_words in lengths
+        ]
+    if name == "Accession #":
+        return [f"ACC{i:08d}" for i in range(n_reports)]
+    if name == "Procedure":
+        return rng.choices(PROCEDURES, k=n_reports)
+    if name in [
+        "Reporting Clinicians",
+        "Authorising Clinician",
+        "Requesting Clinician",
+    ]:
+        return [
+            "\n".join(rng.sample(CLINICIANS, rng.randint(1, 2)))
+            for _ in range(n_reports)
+        ]
+    if name == "Sex":
+        return rng.choices(["M", "F"], k=n_reports)
+    if spec["dtype"] == "date":
+        return [
+            f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/{rng.randint(2018, 2023)} "
+            f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}"
+            for _ in range(n_reports)
+        ]
+    if spec["dtype"] == "integer":
+        return [rng.randint(0, 100) for _ in range(n_reports)]
+    if spec["plot_type"] == "not_plottable":
+        return [f"{name} {i}" for i in np_rng.integers(0, n_reports, n_reports)]
+    return [f"{name} {rng.randint(0, 9)}" for _ in range(n_reports)]
+
+
+def synthetic_ris_df(n_reports, data_format, seed=0):
+    """Raw RIS export, as read from CSV before `process_ris_df`"""
+    rng = random.Random(seed)
+    np_rng = np.random.default_rng(seed)
+    columns = {
+        name: synthetic_column(name, spec, n_reports, rng, np_rng)
+        for name, spec in data_format.items()
+        if not spec["inferred"]
+    }
+    return pd.DataFrame(columns)
+
+
+def textcat_pipeline(labels, multilabel=False):
+    nlp = spacy.blank("en")
+    textcat = nlp.add_pipe("textcat_multilabel" if multilabel else "textcat")
+    for label in labels:
+        textcat.add_label(label)
+    examples = [
+        Example.from_dict(
+            nlp.make_doc(text),
+            {"cats": {l: float(i == 0) for i, l in enumerate(labels)}},
+        )
+        for text in STOCK_NARRATIVES
+    ]
+    nlp.initialize(lambda: examples)
+    return nlp
+
+
+def stand_in_models(model_dir):
+    """Save stand-in pipelines for the spacy models and return their paths
+
+    Only the normality, comparative, info and tokenizer models have stand-ins;
+    the sectioner and domain detector need their trained assets.
+    """
+    info_model = spacy.blank("en")
+    info_model.add_pipe("sentencizer")
+    pipelines = {
+        "normality_cls": textcat_pipeline(["NORMAL", "ABNORMAL", "STOCK"]),
+        "comparative_cls": textcat_pipeline(["IS_COMPARATIVE"], multilabel=True),
+        "info_model": info_model,
+        "tokenizer": spacy.blank("en"),
+    }
+    paths = {}
+    for name, nlp in pipelines.items():
+        paths[name] = str(model_dir / name)
+        nlp.to_disk(paths[name])
+    return paths
@@ -0,0 +1,398 @@
+"""Inference caches for neuroDash
+
+InferenceCache is an on-disk SQLite store of model outputs, keyed by a
+hash of the cleaned report narrative and a fingerprint of the models that
+produced each inferred column. The store survives restarts and can be
+shared by every Streamlit session, and by several processes, on the same
+host. ParsedDocCache keeps recently parsed Docs in memory, DocStore
+keeps the Docs parsed during batch inference on disk, and DecryptCache
+keeps decrypted uploads in temporary files.
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+import srsly
+from spacy.tokens import DocBin, Span, Token
+
+# SQLite limits the number of bound parameters in a single statement
+QUERY_BATCH_SIZE = 500
+FILE_DIGEST_BLOCK_SIZE = 2**20
+# default bounds of the on-disk stores, in rows
+INFERENCE_CACHE_MAX_ROWS = 20_000_000
+DOC_STORE_MAX_ROWS = 500_000
+
+
+def narrative_hash(text):
+    """Return a content hash of a report narrative"""
+    return hashlib.sha256(str(text).encode("utf-8")).hexdigest()
+
+
+def file_digest(f):
+    """Return a content digest of an uploaded or opened file"""
+    hasher = hashlib.blake2b(digest_size=32)
+    if hasattr(f, "getbuffer"):
+        hasher.update(f.getbuffer())
+    else:
+        f.seek(0)
+        for block in iter(lambda: f.read(FILE_DIGEST_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def model_fingerprint(path):
+    """Fingerprint a model directory from its file names, sizes and mtimes
+
+    Paths that are not on disk (e.g. installed spacy package names) are
+    fingerprinted by name only.
+    """
+    hasher = hashlib.sha256(str(path).encode("utf-8"))
+    model_dir = Path(path)
+    if model_dir.is_file():
+        files = [model_dir]
+    else:
+        files = sorted(p for p in model_dir.rglob("*") if p.is_file())
+    for f in files:
+        stat = f.stat()
+        hasher.update(
+            f"{f.relative_to(model_dir.parent)}:{stat.st_size}:{stat.st_mtime_ns}".encode(
+                "utf-8"
+            )
+        )
+    return hasher.hexdigest()
+
+
+class SQLiteStore:
+    """Base class of the on-disk SQLite stores, bounded to `max_rows` rows
+
+    Subclasses name their `table` and give its `columns`. Rows are written
+    with INSERT OR REPLACE, which gives a rewritten row a new rowid, so
+    beyond `max_rows` the rows written longest ago are pruned first. A
+    `max_rows` of None leaves the store unbounded.
+    """
+
+    table = None
+    columns = None
+
+    def __init__(self, path, max_rows=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_rows = max_rows
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} ({self.columns})")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _insert(self, rows):
+        """Write rows, replacing those with the same key, then prune"""
+        if not rows:
+            return
+        placeholders = ",".join("?" * len(rows[0]))
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})", rows
+            )
+            if self.max_rows is not None:
+                self._prune(conn)
+
+    def _prune(self, conn):
+        """Prune the oldest rows once the store may hold more than `max_rows`
+
+        The span of rowids bounds the number of rows from above and is read
+        from the ends of the rowid index, so writes stay cheap until the
+        bound is reached. Finding the cutoff walks the index from the newest
+        row, so the store is pruned to nine tenths of `max_rows` at a time.
+        """
+        # separate subqueries, as SQLite only reads MIN and MAX from the ends
+        # of the index when each is the only aggregate of its query
+        span = conn.execute(
+            f"""SELECT (SELECT MAX(rowid) FROM {self.table})
+            - (SELECT MIN(rowid) FROM {self.table}) + 1"""
+        ).fetchone()[0]
+        if span is None or span <= self.max_rows:
+            return
+        conn.execute(
+            f"""DELETE FROM {self.table} WHERE rowid <= (
+                SELECT rowid FROM {self.table}
+                ORDER BY rowid DESC LIMIT 1 OFFSET ?
+            )""",
+            [self.max_rows - self.max_rows // 10],
+        )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+class InferenceCache(SQLiteStore):
+    """Content-addressed store of per-narrative inference results
+
+    Each report takes a row per inferred column, so the default bound keeps
+    the results of a few million reports.
+    """
+
+    table = "inference"
+    columns = """narrative_hash TEXT NOT NULL,
+        column_name TEXT NOT NULL,
+        model_hash TEXT NOT NULL,
+        value TEXT NOT NULL,
+        PRIMARY KEY (narrative_hash, column_name, model_hash)"""
+
+    def __init__(self, path, max_rows=INFERENCE_CACHE_MAX_ROWS):
+        super().__init__(path, max_rows)
+
+    def get(self, hashes, column, model_hash):
+        """Return a dict of narrative hash to cached value for the hits"""
+        hits = {}
+        unique_hashes = list(set(hashes))
+        with self._connect() as conn:
+            for i in range(0, len(unique_hashes), QUERY_BATCH_SIZE):
+                batch = unique_hashes[i : i + QUERY_BATCH_SIZE]
+                placeholders = ",".join("?" * len(batch))
+                rows = conn.execute(
+                    f"""SELECT narrative_hash, value FROM inference
+                    WHERE column_name = ? AND model_hash = ?
+                    AND narrative_hash IN ({placeholders})""",
+                    [column, model_hash, *batch],
+                )
+                hits.update((h, srsly.json_loads(v)) for h, v in rows)
+        return hits
+
+    def set(self, hashes, column, model_hash, values):
+        """Store inferred values for a column against their narrative hashes"""
+        self._insert(
+            [
+                (h, column, model_hash, srsly.json_dumps(v))
+                for h, v in zip(hashes, values)
+            ]
+        )
+
+
+def _portable_user_data(value):
+    """Replace tokens and spans in extension values by their token offsets"""
+    if isinstance(value, Token):
+        return {"__token__": value.i}
+    if isinstance(value, Span):
+        return {"__span__": [value.start, value.end, value.label_]}
+    if isinstance(value, (list, tuple)):
+        return [_portable_user_data(v) for v in value]
+    return value
+
+
+def _restore_user_data(value, doc):
+    if isinstance(value, dict) and "__token__" in value:
+        return doc[value["__token__"]]
+    if isinstance(value, dict) and "__span__" in value:
+        start, end, label = value["__span__"]
+        return Span(doc, start, end, label=label)
+    if isinstance(value, (list, tuple)):
+        return [_restore_user_data(v, doc) for v in value]
+    return value
+
+
+def doc_to_bytes(doc):
+    """Serialize a Doc with its extension attributes, or None if they can't be"""
+    user_data = doc.user_data
+    doc.user_data = {k: _portable_user_data(v) for k, v in user_data.items()}
+    try:
+        return DocBin(docs=[doc], store_user_data=True).to_bytes()
+    except (TypeError, ValueError):
+        return None
+    finally:
+        doc.user_data = user_data
+
+
+def doc_from_bytes(data, vocab):
+    """Restore a Doc serialized by `doc_to_bytes`"""
+    doc = next(DocBin(store_user_data=True).from_bytes(data).get_docs(vocab))
+    doc.user_data = {k: _restore_user_data(v, doc) for k, v in doc.user_data.items()}
+    return doc
+
+
+class ParsedDocCache:
+    """In-memory LRU cache of parsed Docs, bounded by their serialized size
+
+    Docs are kept as DocBin bytes, with their extension attributes, so each
+    lookup returns a fresh Doc that callers are free to modify.
+    """
+
+    def __init__(self, max_bytes=64 * 2**20):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, vocab):
+        """Return a copy of the cached Doc, or None"""
+        with self._lock:
+            data = self._docs.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._docs.move_to_end(key)
+            self.hits += 1
+        return doc_from_bytes(data, vocab)
+
+    def set(self, key, doc, data=None):
+        """Cache a Doc, returning False if it could not be serialized
+
+        `data` can be given if the Doc has already been serialized.
+        """
+        data = doc_to_bytes(doc) if data is None else data
+        if data is None or len(data) > self.max_bytes:
+            return False
+        with self._lock:
+            if key in self._docs:
+                self.n_bytes -= len(self._docs.pop(key))
+            self._docs[key] = data
+            self.n_bytes += len(data)
+            while self.n_bytes > self.max_bytes:
+                _, evicted = self._docs.popitem(last=False)
+                self.n_bytes -= len(evicted)
+        return True
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class DocStore(SQLiteStore):
+    """On-disk store of the Docs parsed during batch inference
+
+    Each Doc is kept as DocBin bytes against the hash of its narrative and
+    a fingerprint of the model that parsed it, so reports can be displayed
+    with their entities, negations and relations without parsing them again.
+    Reports whose Docs have been pruned are parsed again when displayed.
+    """
+
+    table = "docs"
+    columns = """narrative_hash TEXT NOT NULL,
+        model_hash TEXT NOT NULL,
+        doc BLOB NOT NULL,
+        PRIMARY KEY (narrative_hash, model_hash)"""
+
+    def __init__(self, path, max_rows=DOC_STORE_MAX_ROWS):
+        super().__init__(path, max_rows)
+
+    def get(self, narrative_hash, model_hash):
+        """Return the stored DocBin bytes of a narrative, or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT doc FROM docs WHERE narrative_hash = ? AND model_hash = ?",
+                [narrative_hash, model_hash],
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, hashes, model_hash, docs_bytes):
+        """Store serialized Docs against their narrative hashes"""
+        self._insert(
+            [
+                (h, model_hash, data)
+                for h, data in zip(hashes, docs_bytes)
+                if data is not None
+            ]
+        )
+
+
+class DecryptCache:
+    """Decrypted workbooks spilled to temporary files
+
+    Entries are keyed by a digest of the encrypted upload and the password,
+    so a file is decrypted once however often the dashboard reruns, and are
+    evicted least recently used beyond `max_bytes`. The digest of each
+    Streamlit upload is computed once and remembered by its file id. The
+    temporary directory is only readable by its owner and is removed with
+    the cache.
+    """
+
+    def __init__(self, max_bytes=2 * 2**30, directory=None):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.directory = tempfile.mkdtemp(prefix="neurodash-decrypted-", dir=directory)
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.directory, ignore_errors=True
+        )
+        self._paths = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, f):
+        """Content digest of an upload, computed once per Streamlit file id"""
+        file_id = getattr(f, "file_id", None)
+        with self._lock:
+            if file_id in self._digests:
+                return self._digests[file_id]
+        digest = file_digest(f)
+        if file_id is not None:
+            with self._lock:
+                self._digests[file_id] = digest
+        return digest
+
+    def key(self, f, password):
+        return hashlib.sha256(
+            f"{self.digest(f)}:{password}".encode("utf-8")
+        ).hexdigest()
+
+    def decrypt(self, f, password, decrypt):
+        """Return the decrypted file, opened for reading
+
+        `decrypt(f, password, outfile)` writes the decrypted workbook to
+        `outfile` on a miss.
+        """
+        key = self.key(f, password)
+        with self._lock:
+            path = self._paths.get(key)
+            if path is not None:
+                self._paths.move_to_end(key)
+                return open(path, "rb")
+        fd, part_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                f.seek(0)
+                decrypt(f, password, outfile)
+        except BaseException:
+            os.remove(part_path)
+            raise
+        path = os.path.join(self.directory, key)
+        with self._lock:
+            os.replace(part_path, path)
+            if key not in self._paths:
+                self.n_bytes += os.path.getsize(path)
+            self._paths[key] = path
+            self._paths.move_to_end(key)
+            while self.n_bytes > self.max_bytes and len(self._paths) > 1:
+                _, evicted = self._paths.popitem(last=False)
+                self.n_bytes -= os.path.getsize(evicted)
+                os.remove(evicted)
+            return open(path, "rb")
+
+    def clear(self):
+        with self._lock:
+            for path in self._paths.values():
+                os.remove(path)
+            self._paths.clear()
+            self.n_bytes = 0
+
+    def __len__(self):
+        return len(self._paths)
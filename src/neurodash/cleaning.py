@@ -0,0 +1,63 @@
+"""Narrative cleaning for neuroDash
+
+RIS narratives carry RTF control words and groups, line breaks and
+escaped characters. The cleaning rules are applied in order to each
+narrative in one pass over the string, rather than one pass over the
+whole column per rule, skipping rules that cannot match.
+"""
+
+import multiprocessing
+import re
+
+import pandas as pd
+
+RTF_PATTERN = re.compile(r"\\\w+|\{.*?\}|}")
+NEWLINE_PATTERN = re.compile(r"\n+")
+CARRIAGE_RETURN_PATTERN = re.compile(r"\r+")
+ESCAPE_PATTERN = re.compile(r"_\S+_")
+WHITESPACE_PATTERN = re.compile(r"\s\s+")
+
+# narratives per worker task when cleaning in parallel
+CLEANING_CHUNK_SIZE = 10000
+
+
+def clean_narrative(text):
+    """Clean a single narrative, leaving missing values as they are"""
+    if not isinstance(text, str):
+        return text
+    if "\\" in text or "{" in text or "}" in text:
+        text = RTF_PATTERN.sub("", text)
+    if "\n" in text:
+        text = NEWLINE_PATTERN.sub(" ", text)
+    if "\r" in text:
+        text = CARRIAGE_RETURN_PATTERN.sub(" ", text)
+    text = text.replace(" .", ".")
+    if "_" in text:
+        text = ESCAPE_PATTERN.sub("", text)
+    text = WHITESPACE_PATTERN.sub(" ", text)
+    return text.strip()
+
+
+def _clean_chunk(texts):
+    return [clean_narrative(t) for t in texts]
+
+
+def clean_narratives(narratives, n_workers=1):
+    """Clean a series of narratives
+
+    With `n_workers` above 1, large series are cleaned in chunks across
+    that many worker processes.
+    """
+    texts = narratives.tolist()
+    if n_workers > 1 and len(texts) > CLEANING_CHUNK_SIZE:
+        with multiprocessing.get_context("spawn").Pool(n_workers) as pool:
+            chunks = [
+                texts[i : i + CLEANING_CHUNK_SIZE]
+                for i in range(0, len(texts), CLEANING_CHUNK_SIZE)
+            ]
+            cleaned = [t for chunk in pool.map(_clean_chunk, chunks) for t in chunk]
+    else:
+        cleaned = _clean_chunk(texts)
+    return pd.Series(
+        cleaned, index=narratives.index, dtype=narratives.dtype, name=narratives.name
+    )
@@ -9,6 +9,7 @@ import streamlit as st
 from spacy import displacy
 from spacy.tokens import Span
 
+from neurodash.domains import decode_domains
 from neurodash.utils import get_html
 
 
@@ -76,7 +77,9 @@ def clinical_display(df_row, doc):
         "Compared to previous imaging?": [str(df_row["is_comparative"])],
         "Requesting Clinician": [str(df_row["Requesting Clinician"])],
         "Reporting Clinicians": [str(df_row["Reporting Clinicians"])],
-        "Pathological domains": [", ".join(df_row["pathological_domains"])],
+        "Pathological domains": [
+            ", ".join(decode_domains(df_row["pathological_domains"]))
+        ],
     }
     report_metadata_df = pd.DataFrame.from_dict(report_metadata_dict)
 
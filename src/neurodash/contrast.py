@@ -0,0 +1,41 @@
+"""Contrast detection for neuroDash
+
+A report uses contrast when any of its searched columns contains one of
+that column's marker phrases, matched case-insensitively. The phrases of
+each column are joined into one escaped alternation, so each column is
+searched in a single pass, whether it holds Python or Arrow strings.
+"""
+
+import re
+
+import pandas as pd
+
+DEFAULT_CONTRAST_MARKERS = {
+    "Procedure": ["+c", "contrast", "Post Gad"],
+    "Narrative": ["Post Gad", "MR+c", "+ Gd", "post gadolinium"],
+}
+
+
+def contrast_pattern(markers):
+    """Join contrast marker phrases into one regular expression"""
+    return "|".join(re.escape(m) for m in markers)
+
+
+def uses_contrast(df, contrast_markers=DEFAULT_CONTRAST_MARKERS):
+    """Flag reports whose columns contain any of their contrast marker phrases
+
+    `contrast_markers` maps each column to search to its list of phrases.
+    Empty phrases are ignored, and columns without any are not searched,
+    as an empty pattern would match every report.
+    """
+    contrast_condition = pd.Series(False, index=df.index)
+    for column, markers in contrast_markers.items():
+        markers = [m for m in markers if m]
+        if not markers:
+            continue
+        contrast_condition |= (
+            df[column]
+            .str.contains(contrast_pattern(markers), case=False, regex=True, na=False)
+            .astype(bool)
+        )
+    return contrast_condition
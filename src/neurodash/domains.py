@@ -0,0 +1,105 @@
+"""Pathological domain encoding for neuroDash
+
+Each report's pathological domains are stored as a single integer
+bitmask, with bit i set when the report belongs to
+PATHOLOGICAL_DOMAINS[i]. Boolean views are derived from the mask
+when needed for selection, analysis or export.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+PATHOLOGICAL_DOMAINS = [
+    "Interventional - Surgery",
+    "Cerebrovascular",
+    "Neoplastic & paraneoplastic",
+    "Epilepsy",
+    "Infectious",
+    "Haematological",
+    "Metabolic, Nutritional, & Toxic",
+    "CSF disorders",
+    "Ophthalmological",
+    "Headache",
+    "Endocrine",
+    "Inflammatory & Autoimmune",
+    "Neurodegenerative & Dementia",
+    "Congenital & Developmental",
+    "Traumatic",
+    "Musculoskeletal",
+]
+DOMAIN_BITS = {d: np.uint32(1 << i) for i, d in enumerate(PATHOLOGICAL_DOMAINS)}
+
+logger = logging.getLogger(__name__)
+
+
+def encode_domains(domain_lists):
+    """Encode lists of domain names as a uint32 bitmask per report
+
+    Names missing from PATHOLOGICAL_DOMAINS have no bit, so they are
+    logged and dropped rather than failing the whole batch.
+    """
+    unknown = {d for domains in domain_lists for d in domains} - DOMAIN_BITS.keys()
+    if unknown:
+        logger.warning(
+            "Dropping unknown pathological domains %s, known domains are %s",
+            sorted(unknown),
+            PATHOLOGICAL_DOMAINS,
+        )
+        domain_lists = [
+            [d for d in domains if d in DOMAIN_BITS] for domains in domain_lists
+        ]
+    n_domains = np.fromiter((len(d) for d in domain_lists), dtype=np.int64)
+    rows = np.repeat(np.arange(len(domain_lists)), n_domains)
+    bits = np.fromiter(
+        (DOMAIN_BITS[d] for domains in domain_lists for d in domains),
+        dtype=np.uint32,
+        count=len(rows),
+    )
+    masks = np.zeros(len(domain_lists), dtype=np.uint32)
+    np.bitwise_or.at(masks, rows, bits)
+    return masks
+
+
+def decode_domains(mask):
+    """List the domain names set in a single bitmask"""
+    return [d for d, bit in DOMAIN_BITS.items() if mask & bit]
+
+
+def domains_present(masks):
+    """List the domains set in any of the bitmasks"""
+    combined = np.bitwise_or.reduce(np.asarray(masks, dtype=np.uint32))
+    return decode_domains(combined)
+
+
+def has_all_domains(masks, domains):
+    """Boolean series, True where every one of `domains` is set"""
+    required = np.uint32(sum(int(DOMAIN_BITS[d]) for d in domains))
+    return pd.Series(
+        (masks.to_numpy(dtype=np.uint32) & required) == required, index=masks.index
+    )
+
+
+def domain_membership(masks, domains=None):
+    """Boolean dataframe with a column per domain, derived from the bitmasks
+
+    Defaults to a column for each domain present in any report.
+    """
+    if domains is None:
+        domains = domains_present(masks)
+    bits = np.array([DOMAIN_BITS[d] for d in domains], dtype=np.uint32)
+    membership = (masks.to_numpy(dtype=np.uint32)[:, None] & bits) != 0
+    return pd.DataFrame(membership, index=masks.index, columns=domains)
+
+
+def expand_domain_columns(df, keep_names=True):
+    """Replace the domain bitmask with one boolean column per present domain
+
+    With `keep_names`, the bitmask column is kept as lists of domain names.
+    """
+    masks = df["pathological_domains"]
+    df = df.drop(columns=["pathological_domains"])
+    if keep_names:
+        df["pathological_domains"] = [decode_domains(m) for m in masks]
+    return pd.concat([df, domain_membership(masks)], axis=1)
@@ -0,0 +1,162 @@
+"""Offline enrichment of RIS exports for neuroDash
+
+Runs the dashboard's ingest and inference in batch, outside of
+Streamlit, and writes the enriched reports to a Parquet file that the
+dashboard can load directly without running the models again.
+
+Usage: neurodash-enrich input.csv [input2.xlsx ...] -o enriched.parquet
+"""
+
+import argparse
+import logging
+import os
+from contextlib import ExitStack
+
+import srsly
+from tqdm import tqdm
+
+from neurodash import inference, utils
+
+DEFAULT_CONFIG_PATH = "./dashboard_assets/dashboard_config.json"
+
+
+def open_inputs(paths, stack, password=None):
+    """Open input files as (name, file) pairs, decrypting protected workbooks
+
+    The files are closed with `stack`, an ExitStack. Protected workbooks
+    are decrypted into memory and their encrypted files closed at once.
+    """
+    file_list = []
+    for path in paths:
+        name = os.path.basename(path)
+        f = stack.enter_context(open(path, "rb"))
+        if utils.identify_filetype(name) == "xlsx" and utils.is_encrypted(f):
+            if password is None:
+                raise ValueError(f"{path} is password protected, supply --password")
+            f.seek(0)
+            decrypted = utils.decrypt_xlsx(f, password)
+            f.close()
+            f = decrypted
+        f.seek(0)
+        file_list.append((name, f))
+    return file_list
+
+
+def enrich(
+    input_paths,
+    output_path,
+    data_format,
+    model_paths,
+    n_workers=1,
+    cache_path=None,
+    chunk_size=None,
+    batch_size=128,
+    password=None,
+    doc_store_path=None,
+):
+    """Ingest RIS exports, infer the configured columns and write them to Parquet
+
+    Exports are streamed through reading, cleaning and inference in chunks,
+    which are spooled to disk, so memory use is bounded by the chunk size
+    rather than the size of the exports. By default each chunk holds four
+    worker chunks for every worker process.
+    """
+    inferred_cols = [key for key, vals in data_format.items() if vals["inferred"]]
+    engine = inference.DashboardInferenceEngine(
+        model_paths,
+        cache_path=cache_path,
+        n_workers=n_workers,
+        contrast_markers=data_format["uses_contrast"].get("contrast_markers"),
+        doc_store_path=doc_store_path,
+    )
+    if chunk_size is None:
+        chunk_size = 4 * max(n_workers, 1) * engine.worker_chunk_size
+    stage_stats = {}
+
+    def enriched_chunks(file_list):
+        for chunk in tqdm(
+            utils.iter_file_input(file_list, data_format, chunk_size),
+            desc="chunks",
+        ):
+            yield utils.categorize_columns(
+                engine.infer_addition_report_data(
+                    chunk, infer_data=inferred_cols, batch_size=batch_size
+                ),
+                data_format,
+            )
+            inference.merge_stage_stats(stage_stats, engine.last_inference_stats)
+
+    try:
+        with ExitStack() as stack:
+            n_reports = utils.write_enriched_parquet_chunks(
+                enriched_chunks(open_inputs(input_paths, stack, password)),
+                output_path,
+                inferred_cols,
+            )
+    finally:
+        engine.close()
+    print(f"wrote {n_reports} enriched reports to {output_path}")
+    print(inference.stage_stats_report(stage_stats).round(2).to_string())
+    return stage_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="neurodash-enrich",
+        description="Run neuroDash inference over RIS exports and write an enriched Parquet file",
+    )
+    parser.add_argument("inputs", nargs="+", help="RIS export CSV/XLSX files")
+    parser.add_argument("-o", "--output", required=True, help="output Parquet file")
+    parser.add_argument(
+        "--config", default=DEFAULT_CONFIG_PATH, help="dashboard data config JSON"
+    )
+    parser.add_argument(
+        "--models",
+        default=None,
+        help="JSON file mapping model names to paths, defaults to the dashboard models",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="number of inference worker processes, defaults to all cores",
+    )
+    parser.add_argument(
+        "--cache", default=None, help="inference cache database to reuse and update"
+    )
+    parser.add_argument(
+        "--doc-store",
+        default=None,
+        help="database to keep parsed reports in, for the dashboard's clinical view",
+    )
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--password", default=None, help="password for XLSX files")
+    parser.add_argument(
+        "--log-stats",
+        action="store_true",
+        help="log per-chunk inference stage timings as JSON lines",
+    )
+    args = parser.parse_args()
+    if args.log_stats:
+        logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    model_paths = (
+        srsly.read_json(args.models) if args.models else inference.DEFAULT_MODEL_PATHS
+    )
+    enrich(
+        args.inputs,
+        args.output,
+        srsly.read_json(args.config),
+        model_paths,
+        n_workers=args.workers,
+        cache_path=args.cache,
+        chunk_size=args.chunk_size,
+        batch_size=args.batch_size,
+        password=args.password,
+        doc_store_path=args.doc_store,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,72 @@
+import logging
+import multiprocessing
+import os
 import random
-import re
+import resource
+import threading
+import time
 from collections import defaultdict
+from itertools import islice
+from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import spacy
+import srsly
 from neuradicon.custom_pipes import DomainDetector, SpacySectioner
+from spacy.tokens import Doc
 from spacy.util import minibatch
 from tqdm import tqdm
 
+from neurodash.cache import (DocStore, InferenceCache, ParsedDocCache,
+                             doc_from_bytes, doc_to_bytes, model_fingerprint,
+                             narrative_hash)
+from neurodash.cleaning import clean_narrative
+from neurodash.contrast import DEFAULT_CONTRAST_MARKERS, uses_contrast
+from neurodash.domains import encode_domains
+from neurodash.sections import fill_section_offsets, section_offset_columns
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_PATHS = {
+    "comparative_cls": "./models/en_comp_cls-1.0/en_comp_cls/en_comp_cls-1.0",
+    "section_cls": "./models/en_tok2vec_section_cls-1.0/en_tok2vec_section_cls/en_tok2vec_section_cls-1.0",
+    "normality_cls": "./models/en_tok2vec_binary_norm_v2-2.0.0/en_tok2vec_binary_norm_v2/en_tok2vec_binary_norm_v2-2.0.0",
+    "info_model": "./models/en_neuro_base-1.0/en_neuro_base/en_neuro_base-1.0",
+    "domainer": "./models/pathology_patterns_v4",
+    "tokenizer": "./models/en_core_web_sm/en_core_web_sm-3.0.0",
+}
+
+INFERRED_COLUMNS = [
+    "uses_contrast",
+    "normality_class",
+    "is_comparative",
+    "report_length_words",
+    "sections",
+    "pathological_domains",
+]
+
+# spacy models that tokenize narratives, and the engine attributes holding them
+TOKENIZED_MODELS = {
+    "normality_cls": "normality_model",
+    "comparative_cls": "comparison_model",
+    "info_model": "nlp",
+}
+
+# reports whose inferred columns are kept for reuse by accession number. Each
+# takes about 300 bytes, so the default holds a few 400k-report exports in
+# about 300MB, and a lower bound means more reports are inferred again
+MAX_ENRICHED_REPORTS = 1_000_000
+
+# inferred columns produced by the spacy models, and the models each depends on
+MODEL_COLUMN_DEPENDENCIES = {
+    "normality_class": ["normality_cls"],
+    "is_comparative": ["comparative_cls"],
+    "report_length_words": ["info_model"],
+    "sections": ["tokenizer", "section_cls"],
+    "pathological_domains": ["info_model", "domainer"],
+}
+
 
 def doc_word_length(doc):
     """Calculate the number of words in spacy doc"""
@@ -24,143 +83,1005 @@ def normality_class(doc):
     return max(doc.cats, key=lambda k: doc.cats[k])
 
 
-def uses_contrast(df):
-    contrast_condition = pd.concat(
-        [
-            df["Procedure"].str.contains("+c", case=False, regex=False),
-            df["Procedure"].str.contains("contrast", case=False, regex=False),
-            df["Procedure"].str.contains("Post Gad", case=False, regex=False),
-            df["Narrative"].str.contains("Post Gad", case=False, regex=False),
-            df["Narrative"].str.contains("MR+c", case=False, regex=False),
-            df["Narrative"].str.contains("+ Gd", case=False, regex=False),
-            df["Narrative"].str.contains("post gadolinium", case=False, regex=False),
-        ],
-        axis=1,
-    ).any(axis=1)
-    return contrast_condition
-
-
 def clean_text(string):
     # Decode/reformat text strings
-    new_string = re.sub(r"\\\w+|\{.*?\}|}", "", string)
-    new_string = re.sub(r"(\n+)", " ", new_string)
-    new_string = re.sub(r"(\r+)", " ", new_string)
-    new_string = re.sub(" .", ".", new_string)
-    new_string = re.sub(r"_\S+_", "", new_string)
-    new_string = re.sub(r"\s{2,}", " ", new_string)
-    new_string = new_string.strip()
-    return new_string
+    return clean_narrative(string)
+
+
+def deduplicate_narratives(texts):
+    """Group identical narratives
+
+    Returns an array mapping each narrative to its position in the list of
+    unique narratives, and that list, in order of first appearance.
+    """
+    codes, uniques = pd.factorize(pd.Series(texts), use_na_sentinel=False)
+    return codes, uniques.tolist()
+
+
+def text_lengths(texts):
+    """Approximate the token count of each text by its whitespace-delimited words"""
+    return np.array([len(str(t).split()) for t in texts])
+
+
+def token_budget_batch_sizes(lengths, max_batch_size, max_batch_tokens):
+    """Sizes of consecutive batches holding at most `max_batch_tokens` tokens
+
+    A text longer than the budget is given a batch of its own.
+    """
+    batch_sizes = []
+    n_docs, n_tokens = 0, 0
+    for length in lengths:
+        if n_docs and (
+            n_docs >= max_batch_size or n_tokens + length > max_batch_tokens
+        ):
+            batch_sizes.append(n_docs)
+            n_docs, n_tokens = 0, 0
+        n_docs += 1
+        n_tokens += length
+    if n_docs:
+        batch_sizes.append(n_docs)
+    return batch_sizes
+
+
+def pipe_batches(model, texts, batch_sizes):
+    """Pipe texts through a spacy model in consecutive batches of the given sizes"""
+    texts = iter(texts)
+    for size in batch_sizes:
+        yield from model.pipe(islice(texts, size), batch_size=size)
+
+
+def tokenizer_signature(nlp):
+    """Tokenizer settings of a pipeline, equal for pipelines that tokenize alike"""
+    return nlp.tokenizer.to_bytes(exclude=["vocab"])
+
+
+def saved_tokenizer_signature(path):
+    """Tokenizer settings of a pipeline saved to disk, read without loading it
+
+    A saved pipeline keeps its tokenizer's `tokenizer_signature` in its
+    tokenizer file, and its language and tokenizer factory in its config.
+    Returns None if `path` is not a saved pipeline, e.g. a package name.
+    """
+    model_dir = Path(path)
+    tokenizer_file = model_dir / "tokenizer"
+    config_file = model_dir / "config.cfg"
+    if not (tokenizer_file.is_file() and config_file.is_file()):
+        return None
+    nlp_config = spacy.util.load_config(config_file, interpolate=False)["nlp"]
+    return (
+        nlp_config.get("lang"),
+        dict(nlp_config.get("tokenizer", {})),
+        tokenizer_file.read_bytes(),
+    )
+
+
+def shared_tokens(tokenizer, texts):
+    """Tokens of each text, from a single tokenizer pass
+
+    Each text gets its words, trailing-space flags and the norms set by
+    tokenizer special cases (e.g. "n't" to "not"), by token index, as
+    models embed the norm rather than the text.
+    """
+    return [
+        (
+            [t.text for t in doc],
+            [bool(t.whitespace_) for t in doc],
+            {t.i: t.norm_ for t in doc if t.norm != t.lex.norm},
+        )
+        for doc in tokenizer.pipe(texts)
+    ]
+
+
+def tokens_doc(vocab, words, spaces, norms):
+    """Rebuild a tokenized text as a Doc in another vocab"""
+    doc = Doc(vocab, words=words, spaces=spaces)
+    for i, norm in norms.items():
+        doc[i].norm_ = norm
+    return doc
+
+
+def restore_order(values, order):
+    """Undo the permutation `order` applied to a list of values"""
+    restored = [None] * len(values)
+    for position, index in enumerate(order):
+        restored[index] = values[position]
+    return restored
+
+
+def current_rss():
+    """Resident set size of this process in bytes
+
+    Falls back to the peak RSS where /proc is unavailable.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    """Restart the peak resident set size from the current one
+
+    Only possible on Linux, returns whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes
+
+    The peak since `reset_peak_rss` was last called, or over the lifetime
+    of the process where it cannot be reset.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def record_stage_stats(
+    stats, stage, seconds, n_docs, n_tokens, n_batches, peak_mb=None
+):
+    """Add a run of an inference stage to a dict of per-stage stats
+
+    Repeated runs of a stage, e.g. over chunks or worker shards, are summed,
+    and peak memory is the highest seen. Unless given, the peak is measured
+    since the previous stage was recorded, then reset for the next stage,
+    so stages run concurrently in one process share their peaks.
+    """
+    stage_stats = stats.setdefault(
+        stage,
+        {
+            "seconds": 0.0,
+            "n_docs": 0,
+            "n_tokens": 0,
+            "n_batches": 0,
+            "peak_rss_mb": 0.0,
+        },
+    )
+    stage_stats["seconds"] += seconds
+    stage_stats["n_docs"] += int(n_docs)
+    stage_stats["n_tokens"] += int(n_tokens)
+    stage_stats["n_batches"] += int(n_batches)
+    if peak_mb is None:
+        peak_mb = peak_rss() / 2**20
+        reset_peak_rss()
+    stage_stats["peak_rss_mb"] = max(stage_stats["peak_rss_mb"], peak_mb)
+
+
+def merge_stage_stats(stats, other):
+    """Add the per-stage stats in `other` to `stats`"""
+    for stage, s in other.items():
+        record_stage_stats(
+            stats,
+            stage,
+            s["seconds"],
+            s["n_docs"],
+            s["n_tokens"],
+            s["n_batches"],
+            peak_mb=s["peak_rss_mb"],
+        )
+    return stats
+
+
+def stage_stats_report(stats):
+    """Per-stage stats as a dataframe, with docs/sec and tokens/sec"""
+    report = pd.DataFrame.from_dict(stats, orient="index")
+    if report.empty:
+        return report
+    seconds = report["seconds"].clip(lower=1e-9)
+    report["docs_per_second"] = report["n_docs"] / seconds
+    report["tokens_per_second"] = report["n_tokens"] / seconds
+    return report
+
+
+# models loaded in this process, shared by every engine, and their load costs
+_MODEL_REGISTRY = {}
+MODEL_LOAD_STATS = {}
+_MODEL_REGISTRY_LOCK = threading.RLock()
+
+
+def load_shared_model(key, loader):
+    """Load a model at most once per process
+
+    `key` identifies the model by its path(s) and load options, and
+    `loader` is called to load it the first time it is requested.
+    """
+    with _MODEL_REGISTRY_LOCK:
+        if key not in _MODEL_REGISTRY:
+            start_time, start_rss = time.perf_counter(), current_rss()
+            _MODEL_REGISTRY[key] = loader()
+            MODEL_LOAD_STATS[key] = {
+                "load_seconds": time.perf_counter() - start_time,
+                "rss_increase_mb": (current_rss() - start_rss) / 2**20,
+            }
+            print(
+                "loaded {} in {load_seconds:.1f}s, RSS +{rss_increase_mb:.0f} MB".format(
+                    key, **MODEL_LOAD_STATS[key]
+                )
+            )
+        return _MODEL_REGISTRY[key]
+
+
+def load_domain_detector(nlp, domainer_path):
+    domain_model = DomainDetector(nlp)
+    domain_model.from_disk(domainer_path)
+    return domain_model
 
 
 class DashboardInferenceEngine:
-    def __init__(self, model_path_dict, use_gpu=False):
+    def __init__(
+        self,
+        model_path_dict,
+        use_gpu=False,
+        cache_path=None,
+        n_workers=1,
+        worker_chunk_size=1024,
+        sort_by_length=True,
+        max_batch_tokens=None,
+        contrast_markers=None,
+        doc_cache_bytes=64 * 2**20,
+        doc_store_path=None,
+        share_tokens=True,
+        max_enriched_reports=MAX_ENRICHED_REPORTS,
+    ):
         self.path_dict = model_path_dict
-        self.normality_model = None
-        self.comparison_model = None
-        self.domain_model = None
-        self.nlp = None
-        self.tokenizer = None
-        self.sectioner = None
+        self.use_gpu = use_gpu
+        self.cache = InferenceCache(cache_path) if cache_path else None
+        self._column_fingerprints = {}
+        self.last_dedup_stats = None
+        self.last_inference_stats = {}
+        self.n_workers = n_workers
+        self.worker_chunk_size = worker_chunk_size
+        self._pool = None
+        self.sort_by_length = sort_by_length
+        self.max_batch_tokens = max_batch_tokens
+        self.contrast_markers = contrast_markers or DEFAULT_CONTRAST_MARKERS
+        self.doc_cache = ParsedDocCache(doc_cache_bytes)
+        self.doc_store_path = doc_store_path
+        self.doc_store = DocStore(doc_store_path) if doc_store_path else None
+        self.share_tokens = share_tokens
+        self._shares_tokenizer = {}
+        # inferred columns of reports already enriched, per set of inferred
+        # columns, least recently enriched first
+        self.enriched_reports = {}
+        self.max_enriched_reports = max_enriched_reports
+        self._enriched_lock = threading.Lock()
         if use_gpu:
             spacy.prefer_gpu()
-        self.load_models()
 
     def load_models(self):
-        self.normality_model = spacy.load(self.path_dict["normality_cls"])
-        self.comparison_model = spacy.load(self.path_dict["comparative_cls"])
-        self.nlp = spacy.load(self.path_dict["info_model"])
-        self.tokenizer = spacy.load(
-            self.path_dict["tokenizer"], exclude=["tagger", "parser", "ner"]
+        """Eagerly load every model, rather than on first use"""
+        for model in [
+            "normality_model",
+            "comparison_model",
+            "nlp",
+            "tokenizer",
+            "domain_model",
+            "sectioner",
+        ]:
+            getattr(self, model)
+
+    @property
+    def normality_model(self):
+        path = self.path_dict["normality_cls"]
+        return load_shared_model(("spacy", path), lambda: spacy.load(path))
+
+    @property
+    def comparison_model(self):
+        path = self.path_dict["comparative_cls"]
+        return load_shared_model(("spacy", path), lambda: spacy.load(path))
+
+    @property
+    def nlp(self):
+        path = self.path_dict["info_model"]
+        return load_shared_model(("spacy", path), lambda: spacy.load(path))
+
+    @property
+    def tokenizer(self):
+        path = self.path_dict["tokenizer"]
+        exclude = ["tagger", "parser", "ner"]
+        return load_shared_model(
+            ("spacy", path, *exclude), lambda: spacy.load(path, exclude=exclude)
         )
-        self.domain_model = DomainDetector(self.nlp)
-        self.domain_model.from_disk(self.path_dict["domainer"])
-        self.sectioner = SpacySectioner(
-            self.path_dict["tokenizer"], self.path_dict["section_cls"]
+
+    @property
+    def domain_model(self):
+        nlp = self.nlp
+        key = ("domainer", self.path_dict["info_model"], self.path_dict["domainer"])
+        return load_shared_model(
+            key, lambda: load_domain_detector(nlp, self.path_dict["domainer"])
         )
 
-    def infer_addition_report_data(
+    @property
+    def sectioner(self):
+        key = ("sectioner", self.path_dict["tokenizer"], self.path_dict["section_cls"])
+        return load_shared_model(
+            key,
+            lambda: SpacySectioner(
+                self.path_dict["tokenizer"], self.path_dict["section_cls"]
+            ),
+        )
+
+    @property
+    def doc_fingerprint(self):
+        """Fingerprint of the model whose Docs are kept in the doc store"""
+        return self.column_fingerprint("report_length_words")
+
+    def parse_report(self, text, key=None):
+        """Parse a single report with the info model, reusing earlier parses
+
+        Docs are looked up in the in-memory parsed Doc cache, then in the doc
+        store of Docs kept from batch inference, and only parsed if in
+        neither. `key` identifies the report in the parsed Doc cache, e.g.
+        its accession number, and defaults to a hash of the narrative. The
+        Doc returned is a fresh copy on every call.
+        """
+        key = narrative_hash(text) if key is None else key
+        doc = self.doc_cache.get(key, self.nlp.vocab)
+        if doc is not None:
+            return doc
+        data = None
+        if self.doc_store is not None:
+            data = self.doc_store.get(narrative_hash(text), self.doc_fingerprint)
+        if data is not None:
+            doc = doc_from_bytes(data, self.nlp.vocab)
+        else:
+            doc = self.nlp(text)
+            data = doc_to_bytes(doc)
+            if self.doc_store is not None and data is not None:
+                self.doc_store.set([narrative_hash(text)], self.doc_fingerprint, [data])
+        self.doc_cache.set(key, doc, data=data)
+        return doc
+
+    def model_load_report(self):
+        """Load time and RSS increase of each model loaded in this process"""
+        return pd.DataFrame.from_dict(
+            {" ".join(key): stats for key, stats in MODEL_LOAD_STATS.items()},
+            orient="index",
+        )
+
+    @property
+    def pool(self):
+        """Worker pool, started on first use, whose workers each hold the models"""
+        if self._pool is None:
+            print(f"starting inference pool with {self.n_workers} workers")
+            self._pool = multiprocessing.get_context("spawn").Pool(
+                self.n_workers,
+                initializer=_init_inference_worker,
+                initargs=(
+                    self.path_dict,
+                    {
+                        "use_gpu": self.use_gpu,
+                        "sort_by_length": self.sort_by_length,
+                        "max_batch_tokens": self.max_batch_tokens,
+                        "doc_store_path": self.doc_store_path,
+                        "share_tokens": self.share_tokens,
+                    },
+                ),
+            )
+        return self._pool
+
+    def close(self):
+        """Shut down the worker pool, if running"""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def column_fingerprint(self, column):
+        """Fingerprint of the models an inferred column depends on
+
+        Columns of models that can be given the shared tokens also depend
+        on whether tokens are shared, so the two modes never mix results.
+        """
+        if column not in self._column_fingerprints:
+            models = MODEL_COLUMN_DEPENDENCIES[column]
+            fingerprint = "".join(
+                model_fingerprint(self.path_dict[model]) for model in models
+            )
+            if self.share_tokens and any(m in TOKENIZED_MODELS for m in models):
+                fingerprint += ":shared-tokens"
+            self._column_fingerprints[column] = narrative_hash(fingerprint)
+        return self._column_fingerprints[column]
+
+    def pipe(self, model, texts, batch_size=128, n_processes=1, lengths=None):
+        """Pipe texts, or Docs, through a spacy model
+
+        With `max_batch_tokens` set, batches are sized by their total token
+        count instead of their number of documents, using `lengths` if given.
+        Token-budgeted batches are always processed in-process.
+        """
+        if self.max_batch_tokens:
+            if lengths is None:
+                lengths = text_lengths(texts)
+            batch_sizes = token_budget_batch_sizes(
+                lengths, batch_size, self.max_batch_tokens
+            )
+            return pipe_batches(model, texts, batch_sizes)
+        return model.pipe(texts, batch_size=batch_size, n_process=n_processes)
+
+    def shares_tokenizer(self, model_name):
+        """Whether a model tokenizes like the shared `tokenizer` pipeline
+
+        Pipelines saved to disk are compared from their saved tokenizer
+        settings, so neither is loaded just for the comparison.
+        """
+        if model_name not in self._shares_tokenizer:
+            signature = saved_tokenizer_signature(self.path_dict[model_name])
+            shared_signature = saved_tokenizer_signature(self.path_dict["tokenizer"])
+            if signature is None or shared_signature is None:
+                model = getattr(self, TOKENIZED_MODELS[model_name])
+                signature = tokenizer_signature(model)
+                shared_signature = tokenizer_signature(self.tokenizer)
+            self._shares_tokenizer[model_name] = signature == shared_signature
+            if not self._shares_tokenizer[model_name]:
+                print(f"{model_name} tokenizes differently, using its own tokenizer")
+        return self._shares_tokenizer[model_name]
+
+    def model_inputs(self, model_name, texts, tokens):
+        """Texts to pipe through a model, as Docs built from the shared tokens
+
+        Each model gets Docs of its own, in its own vocab, as components
+        write to them. Falls back to the raw texts when tokens are not
+        shared or the model tokenizes differently.
+        """
+        if tokens is None or not self.shares_tokenizer(model_name):
+            return texts
+        vocab = getattr(self, TOKENIZED_MODELS[model_name]).vocab
+        return (tokens_doc(vocab, *text_tokens) for text_tokens in tokens)
+
+    def n_batches(self, lengths, batch_size=128):
+        """Number of batches `pipe` splits texts of the given lengths into"""
+        if self.max_batch_tokens:
+            return len(
+                token_budget_batch_sizes(lengths, batch_size, self.max_batch_tokens)
+            )
+        return -(-len(lengths) // batch_size)
+
+    def infer_info_data(
         self,
-        df,
-        infer_data=[
-            "uses_contrast",
-            "normality_class",
-            "is_comparative",
-            "report_length_words",
-            "sections",
-            "pathological_domains",
-        ],
+        texts,
+        info_columns,
         batch_size=128,
         n_processes=1,
+        stats=None,
+        tokens=None,
     ):
-        text_iter = df["Narrative"]
+        """Derive all info_model fields from a single parse of each narrative
 
-        if "uses_contrast" in infer_data:
-            print("inferring contrast")
-            df.loc[:, "uses_contrast"] = uses_contrast(df)
+        Each narrative is parsed once by `self.nlp` and the word length and
+        pathological domains are read off the same Doc, rather than running
+        a separate `nlp.pipe` stream per inferred column. The shared parse is
+        timed as the "info" stage and the domain detector as "domains". With
+        a doc store, the parsed Docs are kept for display. `tokens` are the
+        shared tokens of the texts, if any.
+        """
+        stats = {} if stats is None else stats
+        lengths = text_lengths(texts)
+        n_batches = self.n_batches(lengths, batch_size)
+        info_data = {c: [] for c in info_columns}
+        docs_bytes = []
+        domain_seconds, store_seconds = 0.0, 0.0
+        start = time.perf_counter()
+        for doc in tqdm(
+            self.pipe(
+                self.nlp,
+                self.model_inputs("info_model", texts, tokens),
+                batch_size=batch_size,
+                n_processes=n_processes,
+                lengths=lengths,
+            )
+        ):
+            if "report_length_words" in info_data:
+                info_data["report_length_words"].append(doc_word_length(doc))
+            if "pathological_domains" in info_data:
+                domain_start = time.perf_counter()
+                info_data["pathological_domains"].append(
+                    self.domain_model(doc)._.domains
+                )
+                domain_seconds += time.perf_counter() - domain_start
+            if self.doc_store is not None:
+                store_start = time.perf_counter()
+                docs_bytes.append(doc_to_bytes(doc))
+                store_seconds += time.perf_counter() - store_start
+        record_stage_stats(
+            stats,
+            "info",
+            time.perf_counter() - start - domain_seconds - store_seconds,
+            len(texts),
+            lengths.sum(),
+            n_batches,
+        )
+        if self.doc_store is not None:
+            store_start = time.perf_counter()
+            self.doc_store.set(
+                [narrative_hash(t) for t in texts], self.doc_fingerprint, docs_bytes
+            )
+            store_seconds += time.perf_counter() - store_start
+            record_stage_stats(
+                stats, "doc_store", store_seconds, len(texts), lengths.sum(), 1
+            )
+        if "pathological_domains" in info_data:
+            # detected domain by domain during the info stage, sharing its peak
+            record_stage_stats(
+                stats,
+                "domains",
+                domain_seconds,
+                len(texts),
+                lengths.sum(),
+                len(texts),
+                peak_mb=stats["info"]["peak_rss_mb"],
+            )
+        return info_data
+
+    def infer_narrative_data(
+        self, texts, model_columns, batch_size=128, n_processes=1, stats=None
+    ):
+        """Run the spacy models over narratives
+
+        Returns a dict mapping each requested model column to a list with
+        one value per narrative, in the order of `texts`. With
+        `sort_by_length` set, narratives are run through the models in order
+        of length so that batches hold documents of similar size. Timings of
+        each stage are recorded in `stats`, if given.
+        """
+        stats = {} if stats is None else stats
+        texts = list(texts)
+        lengths = text_lengths(texts)
+        if self.sort_by_length:
+            order = np.argsort(lengths, kind="stable")
+            texts = [texts[i] for i in order]
+            lengths = lengths[order]
+        n_tokens = lengths.sum()
+        n_batches = self.n_batches(lengths, batch_size)
+        narrative_data = {}
+
+        tokens = None
+        tokenized_models = [
+            model
+            for column, model in [
+                ("normality_class", "normality_cls"),
+                ("is_comparative", "comparative_cls"),
+                ("report_length_words", "info_model"),
+                ("pathological_domains", "info_model"),
+            ]
+            if column in model_columns
+        ]
+        if self.share_tokens and any(
+            self.shares_tokenizer(m) for m in tokenized_models
+        ):
+            start = time.perf_counter()
+            tokens = shared_tokens(self.tokenizer.tokenizer, texts)
+            record_stage_stats(
+                stats,
+                "tokenize",
+                time.perf_counter() - start,
+                len(texts),
+                n_tokens,
+                1,
+            )
 
-        if "normality_class" in infer_data:
+        if "normality_class" in model_columns:
             print("inferring normality_class")
-            norm_classes = [
+            start = time.perf_counter()
+            narrative_data["normality_class"] = [
                 normality_class(doc)
                 for doc in tqdm(
-                    self.normality_model.pipe(
-                        text_iter, batch_size=batch_size, n_process=n_processes
+                    self.pipe(
+                        self.normality_model,
+                        self.model_inputs("normality_cls", texts, tokens),
+                        batch_size=batch_size,
+                        n_processes=n_processes,
+                        lengths=lengths,
                     )
                 )
             ]
+            record_stage_stats(
+                stats,
+                "normality",
+                time.perf_counter() - start,
+                len(texts),
+                n_tokens,
+                n_batches,
+            )
 
-            df.loc[:, "normality_class"] = norm_classes
-
-        if "is_comparative" in infer_data:
+        if "is_comparative" in model_columns:
             print("inferring is_comparitive")
-            comp_classes = [
+            start = time.perf_counter()
+            narrative_data["is_comparative"] = [
                 is_comparitive(doc)
                 for doc in tqdm(
-                    self.comparison_model.pipe(
-                        text_iter, batch_size=batch_size, n_process=n_processes
+                    self.pipe(
+                        self.comparison_model,
+                        self.model_inputs("comparative_cls", texts, tokens),
+                        batch_size=batch_size,
+                        n_processes=n_processes,
+                        lengths=lengths,
                     )
                 )
             ]
-            df.loc[:, "is_comparative"] = comp_classes
+            record_stage_stats(
+                stats,
+                "comparative",
+                time.perf_counter() - start,
+                len(texts),
+                n_tokens,
+                n_batches,
+            )
 
-        if "report_length_words" in infer_data:
-            print("inferring report_word_length")
-            lengths = [
-                doc_word_length(doc)
-                for doc in tqdm(
-                    self.nlp.pipe(
-                        text_iter, batch_size=batch_size, n_process=n_processes
-                    )
+        info_columns = [
+            c
+            for c in ["report_length_words", "pathological_domains"]
+            if c in model_columns
+        ]
+        if info_columns:
+            print(f"inferring {', '.join(info_columns)}")
+            narrative_data.update(
+                self.infer_info_data(
+                    texts,
+                    info_columns,
+                    batch_size=batch_size,
+                    n_processes=n_processes,
+                    stats=stats,
+                    tokens=tokens,
                 )
-            ]
-
-            df.loc[:, "report_length_words"] = lengths
+            )
 
-        if "sections" in infer_data:
+        # the sectioner takes raw texts, so always tokenizes them itself
+        if "sections" in model_columns:
             print("inferring sections")
-            sectioned_reports = self.sectioner(
-                text_iter, batch_size=batch_size, n_procs=n_processes
+            start = time.perf_counter()
+            narrative_data["sections"] = list(
+                self.sectioner(texts, batch_size=batch_size, n_procs=n_processes)
+            )
+            record_stage_stats(
+                stats,
+                "sections",
+                time.perf_counter() - start,
+                len(texts),
+                n_tokens,
+                -(-len(texts) // batch_size),
             )
-            section_df = pd.DataFrame(sectioned_reports)
-            for col in section_df.columns:
-                df.loc[:, col] = section_df[col].tolist()
 
-        if "pathological_domains" in infer_data:
-            print("inferring pathological domains")
-            domains = [
-                self.domain_model(doc)._.domains
-                for doc in tqdm(
-                    self.nlp.pipe(
-                        text_iter, batch_size=batch_size, n_process=n_processes
-                    )
-                )
-            ]
-            df.loc[:, "pathological_domains"] = domains
-            unique_domains = (d for doc in domains for d in doc)
-            individual_domains_membership = {
-                domain: [domain in doc for doc in domains] for domain in unique_domains
+        if self.sort_by_length:
+            narrative_data = {
+                col: restore_order(values, order)
+                for col, values in narrative_data.items()
             }
-            domain_df = pd.DataFrame.from_dict(individual_domains_membership)
-            for col in domain_df.columns:
-                df.loc[:, col] = domain_df[col].tolist()
+        return narrative_data
+
+    def infer_pooled_narrative_data(
+        self, texts, model_columns, batch_size=128, stats=None
+    ):
+        """Run the spacy models over narratives sharded across the worker pool
+
+        Shards are at most `worker_chunk_size` narratives, and smaller when
+        needed to give every worker a share. Stage timings recorded in
+        `stats` are summed over the workers.
+        """
+        stats = {} if stats is None else stats
+        texts = list(texts)
+        shard_size = min(self.worker_chunk_size, -(-len(texts) // self.n_workers))
+        chunks = [
+            (chunk, model_columns, batch_size)
+            for chunk in minibatch(texts, size=max(shard_size, 1))
+        ]
+        narrative_data = {c: [] for c in model_columns}
+        for chunk_data, chunk_stats in tqdm(
+            self.pool.imap(_infer_worker_chunk, chunks), total=len(chunks)
+        ):
+            merge_stage_stats(stats, chunk_stats)
+            for column, values in chunk_data.items():
+                narrative_data[column].extend(values)
+        return narrative_data
+
+    def run_models(
+        self, texts, model_columns, batch_size=128, n_processes=1, stats=None
+    ):
+        """Run the spacy models in-process, or on the worker pool if configured"""
+        if self.n_workers > 1:
+            return self.infer_pooled_narrative_data(
+                texts, model_columns, batch_size=batch_size, stats=stats
+            )
+        return self.infer_narrative_data(
+            texts,
+            model_columns,
+            batch_size=batch_size,
+            n_processes=n_processes,
+            stats=stats,
+        )
+
+    def infer_cached_narrative_data(
+        self, texts, model_columns, batch_size=128, n_processes=1, stats=None
+    ):
+        """Run the spacy models over narratives, reusing cached results
+
+        Only narratives missing from the cache for a given column are
+        inferred, and their results are written back to the cache.
+        """
+        texts = list(texts)
+        hashes = [narrative_hash(t) for t in texts]
+        narrative_data = {}
+        columns_by_misses = defaultdict(list)
+        for column in model_columns:
+            hits = self.cache.get(hashes, column, self.column_fingerprint(column))
+            narrative_data[column] = [hits.get(h) for h in hashes]
+            misses = tuple(i for i, h in enumerate(hashes) if h not in hits)
+            print(f"{column}: {len(texts) - len(misses)}/{len(texts)} cached")
+            if misses:
+                columns_by_misses[misses].append(column)
+
+        for misses, columns in columns_by_misses.items():
+            inferred = self.run_models(
+                [texts[i] for i in misses],
+                columns,
+                batch_size=batch_size,
+                n_processes=n_processes,
+                stats=stats,
+            )
+            for column, values in inferred.items():
+                for i, value in zip(misses, values):
+                    narrative_data[column][i] = value
+                self.cache.set(
+                    [hashes[i] for i in misses],
+                    column,
+                    self.column_fingerprint(column),
+                    values,
+                )
+        return narrative_data
+
+    def infer_addition_report_data(
+        self,
+        df,
+        infer_data=INFERRED_COLUMNS,
+        batch_size=128,
+        n_processes=1,
+        return_stats=False,
+    ):
+        """Add the inferred columns to a dataframe of reports
+
+        Per-stage timings are kept in `last_inference_stats`, logged as a
+        JSON line, and returned alongside the dataframe with `return_stats`.
+        """
+        text_iter = df["Narrative"]
+        stats = {}
+        reset_peak_rss()
+
+        if "uses_contrast" in infer_data:
+            print("inferring contrast")
+            start = time.perf_counter()
+            df.loc[:, "uses_contrast"] = uses_contrast(df, self.contrast_markers)
+            record_stage_stats(
+                stats,
+                "contrast",
+                time.perf_counter() - start,
+                len(df),
+                text_lengths(text_iter).sum(),
+                1,
+            )
+
+        model_columns = [c for c in MODEL_COLUMN_DEPENDENCIES if c in infer_data]
+        codes, unique_texts = deduplicate_narratives(text_iter)
+        self.last_dedup_stats = {
+            "n_narratives": len(codes),
+            "n_unique": len(unique_texts),
+            "dedup_ratio": len(codes) / max(len(unique_texts), 1),
+        }
+        print(
+            "{n_narratives} narratives, {n_unique} unique "
+            "(dedup ratio {dedup_ratio:.2f})".format(**self.last_dedup_stats)
+        )
+        if self.cache is not None:
+            unique_data = self.infer_cached_narrative_data(
+                unique_texts,
+                model_columns,
+                batch_size=batch_size,
+                n_processes=n_processes,
+                stats=stats,
+            )
+        else:
+            unique_data = self.run_models(
+                unique_texts,
+                model_columns,
+                batch_size=batch_size,
+                n_processes=n_processes,
+                stats=stats,
+            )
+        narrative_data = {
+            col: [values[i] for i in codes] for col, values in unique_data.items()
+        }
+
+        for col in ["normality_class", "is_comparative", "report_length_words"]:
+            if col in narrative_data:
+                df.loc[:, col] = narrative_data[col]
+
+        if "sections" in narrative_data:
+            for col, offsets in section_offset_columns(
+                df["Narrative"], narrative_data["sections"]
+            ).items():
+                df.loc[:, col] = offsets
+
+        if "pathological_domains" in narrative_data:
+            df.loc[:, "pathological_domains"] = encode_domains(
+                narrative_data["pathological_domains"]
+            )
+
+        self.last_inference_stats = stats
+        logger.info(
+            srsly.json_dumps(
+                {"event": "inference_stats", "n_reports": len(df), "stages": stats}
+            )
+        )
+        if return_stats:
+            return df, stats
         return df
+
+    def record_enriched_reports(self, df, hashes, infer_data, inferred_columns):
+        """Keep the inferred columns of enriched reports, by accession number
+
+        At most `max_enriched_reports` are kept across all sets of inferred
+        columns, evicting the least recently enriched or reused.
+        """
+        records = df.loc[df["Accession #"].notna(), inferred_columns].copy()
+        records["narrative_hash"] = [
+            h for h, known in zip(hashes, df["Accession #"].notna()) if known
+        ]
+        records.index = df.loc[df["Accession #"].notna(), "Accession #"].to_numpy()
+        key = tuple(infer_data)
+        with self._enriched_lock:
+            previous = self.enriched_reports.get(key)
+            if previous is not None:
+                records = pd.concat(
+                    [previous[~previous.index.isin(records.index)], records]
+                )
+            self.enriched_reports.pop(key, None)
+            self.enriched_reports[key] = records[~records.index.duplicated(keep="last")]
+            self._evict_enriched_reports()
+
+    def _evict_enriched_reports(self):
+        n_excess = (
+            sum(len(records) for records in self.enriched_reports.values())
+            - self.max_enriched_reports
+        )
+        kept = {}
+        for key, records in self.enriched_reports.items():
+            if n_excess > 0:
+                n_evicted = min(n_excess, len(records))
+                records = records.iloc[n_evicted:]
+                n_excess -= n_evicted
+            if len(records):
+                kept[key] = records
+        self.enriched_reports = kept
+
+    def infer_incremental_report_data(
+        self,
+        df,
+        infer_data=INFERRED_COLUMNS,
+        batch_size=128,
+        n_processes=1,
+    ):
+        """Add the inferred columns, only running inference on new reports
+
+        Reports are matched by accession number to those enriched before
+        with the same inferred columns. Unseen reports, and those whose
+        narrative has changed, are inferred and recorded, and the rest
+        reuse their recorded columns. Row order is preserved.
+        """
+        start = time.perf_counter()
+        hashes = np.array([narrative_hash(t) for t in df["Narrative"]])
+        with self._enriched_lock:
+            enriched = self.enriched_reports.get(tuple(infer_data))
+        if enriched is None:
+            reuse = np.zeros(len(df), dtype=bool)
+        else:
+            positions = enriched.index.get_indexer(df["Accession #"])
+            reuse = (positions >= 0) & (
+                enriched["narrative_hash"].to_numpy()[positions] == hashes
+            )
+        parts = []
+        if reuse.any():
+            reused = df[reuse].copy()
+            recorded = enriched.iloc[positions[reuse]].drop(columns="narrative_hash")
+            for col in recorded.columns:
+                reused[col] = recorded[col].to_numpy()
+            self.record_enriched_reports(
+                reused, hashes[reuse], infer_data, list(recorded.columns)
+            )
+            parts.append(reused)
+        stats = {}
+        if not reuse.all():
+            new_reports = df[~reuse].copy()
+            input_columns = set(new_reports.columns)
+            inferred = self.infer_addition_report_data(
+                new_reports,
+                infer_data=infer_data,
+                batch_size=batch_size,
+                n_processes=n_processes,
+            )
+            stats = self.last_inference_stats
+            self.record_enriched_reports(
+                inferred,
+                hashes[~reuse],
+                infer_data,
+                [
+                    c
+                    for c in inferred.columns
+                    if c not in input_columns or c in infer_data
+                ],
+            )
+            parts.append(inferred)
+        order = np.concatenate([np.flatnonzero(reuse), np.flatnonzero(~reuse)])
+        result = fill_section_offsets(
+            pd.concat(parts).iloc[np.argsort(order, kind="stable")]
+        )
+        print(f"{reuse.sum()}/{len(df)} reports already enriched")
+        if reuse.any():
+            record_stage_stats(
+                stats,
+                "incremental_reuse",
+                time.perf_counter() - start,
+                reuse.sum(),
+                text_lengths(df.loc[reuse, "Narrative"]).sum(),
+                1,
+            )
+        self.last_inference_stats = stats
+        return result
+
+    def iter_infer_addition_report_data(
+        self,
+        df,
+        infer_data=INFERRED_COLUMNS,
+        chunk_size=5000,
+        batch_size=128,
+        n_processes=1,
+        incremental=False,
+    ):
+        """Infer additional report data over consecutive chunks of rows
+
+        Yields each enriched chunk as soon as it is complete, so results can
+        be shown progressively and working memory stays bounded by the chunk
+        size. With `incremental`, reports enriched before are reused, see
+        `infer_incremental_report_data`.
+        """
+        infer = (
+            self.infer_incremental_report_data
+            if incremental
+            else self.infer_addition_report_data
+        )
+        for start in range(0, len(df), chunk_size):
+            chunk = df.iloc[start : start + chunk_size].copy()
+            yield infer(
+                chunk,
+                infer_data=infer_data,
+                batch_size=batch_size,
+                n_processes=n_processes,
+            )
+
+
+# engine held by each process of the inference worker pool
+_worker_engine = None
+
+
+def _init_inference_worker(model_path_dict, engine_kwargs):
+    global _worker_engine
+    _worker_engine = DashboardInferenceEngine(model_path_dict, **engine_kwargs)
+
+
+def _infer_worker_chunk(args):
+    texts, model_columns, batch_size = args
+    stats = {}
+    narrative_data = _worker_engine.infer_narrative_data(
+        texts, model_columns, batch_size=batch_size, stats=stats
+    )
+    return narrative_data, stats
@@ -0,0 +1,215 @@
+"""Background inference jobs for neuroDash
+
+Uploads are ingested and run through the inference engine on a
+background thread, independently of Streamlit script runs. Each
+upload becomes an InferenceJob with a status, progress and result,
+which the dashboard polls. Active jobs take turns one chunk of rows
+at a time, so concurrent uploads share the inference engine fairly.
+Uploads are read on a thread of their own, so a large upload does not
+hold up other jobs while it is ingested.
+"""
+
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from neurodash.inference import merge_stage_stats
+from neurodash.sections import fill_section_offsets
+from neurodash.utils import concat_reports, read_file_input
+
+ACTIVE_STATUSES = ("queued", "running")
+# longest a job's turn waits on its upload being read
+INGEST_POLL_SECONDS = 0.1
+
+
+class InferenceJob:
+    """Ingest and inference of one upload"""
+
+    def __init__(self, owner, file_list, data_format, chunk_size, batch_size):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.file_list = file_list
+        self.data_format = data_format
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.status = "queued"
+        self.n_total = 0
+        self.chunks = []
+        self.stage_stats = {}
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._steps = None
+
+    @property
+    def n_done(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    @property
+    def progress(self):
+        return self.n_done / self.n_total if self.n_total else 0.0
+
+    @property
+    def elapsed_seconds(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def _iter_chunks(self, inference_engine):
+        """Read the upload, then yield enriched chunks of reports
+
+        None is yielded while the upload is still being read, ending the
+        job's turn. Files that were already enriched offline only have the
+        inferred columns they lack run through the models, and reports
+        enriched by an earlier upload are reused rather than inferred again.
+        """
+        pool = ThreadPoolExecutor(max_workers=1)
+        reading = pool.submit(read_file_input, self.file_list, self.data_format)
+        pool.shutdown(wait=False)
+        while not wait([reading], timeout=INGEST_POLL_SECONDS).done:
+            yield None
+        report_dfs = reading.result()
+        self.n_total = sum(len(df) for df in report_dfs)
+        inferred_cols = [
+            key for key, vals in self.data_format.items() if vals["inferred"]
+        ]
+        for report_df in report_dfs:
+            infer_data = [
+                c for c in inferred_cols if c not in report_df.attrs.get("inferred", [])
+            ]
+            if not infer_data:
+                yield report_df
+                continue
+            for chunk in inference_engine.iter_infer_addition_report_data(
+                report_df,
+                infer_data=infer_data,
+                chunk_size=self.chunk_size,
+                batch_size=self.batch_size,
+                incremental=True,
+            ):
+                # replaced rather than updated, as the dashboard reads it
+                stage_stats = {k: dict(v) for k, v in self.stage_stats.items()}
+                self.stage_stats = merge_stage_stats(
+                    stage_stats, inference_engine.last_inference_stats
+                )
+                yield chunk
+
+    def step(self, inference_engine):
+        """Advance the job by one chunk of reports"""
+        if self._steps is None:
+            self.status = "running"
+            self.started_at = time.time()
+            self._steps = self._iter_chunks(inference_engine)
+        try:
+            chunk = next(self._steps, StopIteration)
+            if chunk is StopIteration:
+                self.result = self._collect_result()
+                self.status = "done"
+                self.finished_at = time.time()
+            elif chunk is not None:
+                self.chunks.append(chunk)
+        except Exception:
+            self.fail(traceback.format_exc())
+
+    def _collect_result(self):
+        if not self.n_done:
+            raise Exception("No reports found in the uploaded files")
+        return fill_section_offsets(concat_reports(self.chunks, self.data_format))
+
+    def fail(self, error):
+        self.error = error
+        self.status = "failed"
+        self.finished_at = time.time()
+
+    def cancel(self):
+        if self.status in ACTIVE_STATUSES:
+            self.status = "cancelled"
+            self.finished_at = time.time()
+
+
+class InferenceJobQueue:
+    """Runs inference jobs on a background thread, round-robin by chunk
+
+    Each owner (a dashboard session) has at most one active job; submitting
+    a new one cancels the previous. Finished jobs are kept until collected
+    with `pop_result`, or for `retention_seconds`.
+    """
+
+    def __init__(
+        self, inference_engine, chunk_size=5000, batch_size=128, retention_seconds=3600
+    ):
+        self.inference_engine = inference_engine
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.retention_seconds = retention_seconds
+        self.jobs = {}
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="neurodash-inference-jobs", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, owner, file_list, data_format):
+        """Queue an upload for inference, returning the job id"""
+        job = InferenceJob(
+            owner, file_list, data_format, self.chunk_size, self.batch_size
+        )
+        with self._lock:
+            for other in self.jobs.values():
+                if other.owner == owner:
+                    other.cancel()
+            self.jobs[job.id] = job
+            self._queue.append(job.id)
+            self._wakeup.set()
+        return job.id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def pop_result(self, job_id):
+        """Collect a finished job's result and forget the job"""
+        with self._lock:
+            job = self.jobs.pop(job_id)
+        return job.result
+
+    def _next_job(self):
+        with self._lock:
+            self._forget_expired()
+            while self._queue:
+                job = self.jobs.get(self._queue.popleft())
+                if job is not None and job.status in ACTIVE_STATUSES:
+                    return job
+            self._wakeup.clear()
+            return None
+
+    def _forget_expired(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at and now - job.finished_at > self.retention_seconds:
+                del self.jobs[job_id]
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            job = None
+            try:
+                job = self._next_job()
+                if job is None:
+                    continue
+                job.step(self.inference_engine)
+            except Exception:
+                # a job that breaks the scheduler fails alone
+                if job is None:
+                    traceback.print_exc()
+                    continue
+                job.fail(traceback.format_exc())
+            if job.status in ACTIVE_STATUSES:
+                with self._lock:
+                    self._queue.append(job.id)
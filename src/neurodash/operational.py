@@ -8,46 +8,12 @@ import pandas as pd
 import plotly.express as px
 import streamlit as st
 
+from neurodash.domains import PATHOLOGICAL_DOMAINS, has_all_domains
+from neurodash.inference import stage_stats_report
 from neurodash.utils import (get_multilabel_select_options,
                              get_multiselect_options)
 
-PATHOLOGICAL_DOMAINS = [
-    "Interventional - Surgery",
-    "Cerebrovascular",
-    "Neoplastic & paraneoplastic",
-    "Epilepsy",
-    "Infectious",
-    "Haematological",
-    "Metabolic, Nutritional, & Toxic",
-    "CSF disorders",
-    "Ophthalmological",
-    "Headache",
-    "Endocrine",
-    "Inflammatory & Autoimmune",
-    "Neurodegenerative & Dementia",
-    "Congenital & Developmental",
-    "Traumatic",
-    "Musculoskeletal",
-]
-PATHOLOGICAL_DOMAINS_WITH_ALL = [
-    "all",
-    "Interventional - Surgery",
-    "Cerebrovascular",
-    "Neoplastic & paraneoplastic",
-    "Epilepsy",
-    "Infectious",
-    "Haematological",
-    "Metabolic, Nutritional, & Toxic",
-    "CSF disorders",
-    "Ophthalmological",
-    "Headache",
-    "Endocrine",
-    "Inflammatory & Autoimmune",
-    "Neurodegenerative & Dementia",
-    "Congenital & Developmental",
-    "Traumatic",
-    "Musculoskeletal",
-]
+PATHOLOGICAL_DOMAINS_WITH_ALL = ["all"] + PATHOLOGICAL_DOMAINS
 
 
 def selection_display(report_df, data_config):
@@ -181,9 +147,10 @@ def selection_display(report_df, data_config):
     if "all" in multilabel_select_vals["pathological_domains"]:
         domain_criterion = True
     else:
-        domain_criterion = report_df[
-            multilabel_select_vals["pathological_domains"]
-        ].all(axis="columns")
+        domain_criterion = has_all_domains(
+            report_df["pathological_domains"],
+            multilabel_select_vals["pathological_domains"],
+        )
 
     selection_criteria = (
         (report_df["Age"].between(min_select_age, max_select_age))
@@ -249,6 +216,7 @@ def plot_categorical(
     counts = (
         df[column_name]
         .value_counts(normalize=False)
+        .loc[lambda c: c > 0]
         .rename_axis(variable_name)
         .to_frame("counts")
         .reset_index()
@@ -288,6 +256,7 @@ def plot_categorical_temporal(
                 index=[temporal_variable],
                 columns=[column_name],
                 aggfunc="sum",
+                observed=True,
             )
             .resample(interval)
             .sum()
@@ -468,3 +437,63 @@ def summary_display(report_df, data_config):
         categorical_summary_description,
         basic_summary_description,
     )
+
+
+def inference_progress_display(report_chunks, n_total, elapsed_seconds, show_summary):
+    """display inference progress and summaries of the reports inferred so far"""
+    if not n_total:
+        st.progress(0.0, text="Reading uploaded files")
+        return
+    n_done = sum(len(chunk) for chunk in report_chunks)
+    if not n_done:
+        st.progress(0.0, text=f"Queued {n_total} reports for inference")
+        return
+    rate = n_done / max(elapsed_seconds, 1e-9)
+    remaining = (n_total - n_done) / rate
+    st.progress(
+        n_done / n_total,
+        text=f"Inferred {n_done} of {n_total} reports ({rate:.0f} reports/s, about {remaining:.0f}s remaining)",
+    )
+    if not show_summary:
+        return
+    summary_columns = ["MRN", "End Exam Date", "normality_class"]
+    report_df = pd.concat(
+        [chunk[[c for c in summary_columns if c in chunk]] for chunk in report_chunks]
+    )
+    basic_summary = pd.DataFrame.from_dict(
+        {
+            "start_date": [report_df["End Exam Date"].dt.date.min()],
+            "end_date": [report_df["End Exam Date"].dt.date.max()],
+            "n_reports": [n_done],
+            "n_unique_patients": [report_df["MRN"].nunique()],
+        }
+    )
+    col1, col2 = st.columns([1, 2])
+    with col1:
+        st.table(basic_summary)
+    if "normality_class" in report_df:
+        with col2:
+            st.table(report_df["normality_class"].value_counts())
+
+
+def inference_stats_display(stage_stats, model_load_report):
+    """display per-stage inference timings and model load costs in the sidebar"""
+    st.sidebar.subheader("Inference stages")
+    if stage_stats:
+        report = stage_stats_report(stage_stats)
+        st.sidebar.dataframe(
+            report[
+                [
+                    "seconds",
+                    "docs_per_second",
+                    "tokens_per_second",
+                    "n_batches",
+                    "peak_rss_mb",
+                ]
+            ].round(1)
+        )
+    else:
+        st.sidebar.text("No reports inferred yet")
+    st.sidebar.subheader("Model loading")
+    if not model_load_report.empty:
+        st.sidebar.dataframe(model_load_report.round(1))
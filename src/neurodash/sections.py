@@ -0,0 +1,110 @@
+"""Report section encoding for neuroDash
+
+Each section found by the sectioner is stored as a pair of int32 columns,
+`<section>_start` and `<section>_end`, holding its character offsets into
+the report's Narrative, with -1 where a report lacks the section. Section
+text is sliced from the narrative only when displayed or exported. The
+few sections whose text is not found in their narrative are kept as text,
+in a `<section>_text` column that is otherwise empty.
+"""
+
+import numpy as np
+import pandas as pd
+
+START_SUFFIX = "_start"
+END_SUFFIX = "_end"
+TEXT_SUFFIX = "_text"
+MISSING_OFFSET = -1
+
+
+def section_offset_columns(narratives, sections):
+    """Locate each report's section texts in its narrative
+
+    `sections` holds a dict of section name to text per narrative, as
+    returned by the sectioner. Returns a dict of int32 offset columns, and
+    of text columns for sections with text not found in their narrative.
+    """
+    names = list(dict.fromkeys(name for s in sections for name in s))
+    offsets = {
+        name: np.full((len(sections), 2), MISSING_OFFSET, dtype=np.int32)
+        for name in names
+    }
+    unlocated = {}
+    for i, (narrative, report_sections) in enumerate(zip(narratives, sections)):
+        if not isinstance(narrative, str):
+            continue
+        search_from = 0
+        for name, text in report_sections.items():
+            if not isinstance(text, str):
+                continue
+            start = narrative.find(text, search_from)
+            if start < 0:
+                start = narrative.find(text)
+            if start < 0:
+                unlocated.setdefault(name, {})[i] = text
+                continue
+            offsets[name][i] = start, start + len(text)
+            search_from = start + len(text)
+    if unlocated:
+        n_unlocated = sum(len(texts) for texts in unlocated.values())
+        print(f"{n_unlocated} sections not found in their narrative, kept as text")
+    columns = {}
+    for name, section_offsets in offsets.items():
+        columns[name + START_SUFFIX] = section_offsets[:, 0]
+        columns[name + END_SUFFIX] = section_offsets[:, 1]
+        if name in unlocated:
+            columns[name + TEXT_SUFFIX] = [
+                unlocated[name].get(i) for i in range(len(sections))
+            ]
+    return columns
+
+
+def section_names(df):
+    """Names of the sections with offset columns in a report dataframe"""
+    return [
+        c[: -len(START_SUFFIX)]
+        for c in df.columns
+        if c.endswith(START_SUFFIX)
+        and c[: -len(START_SUFFIX)] + END_SUFFIX in df.columns
+    ]
+
+
+def fill_section_offsets(df):
+    """Restore int32 offsets after concatenating reports with different sections"""
+    for name in section_names(df):
+        for col in [name + START_SUFFIX, name + END_SUFFIX]:
+            if df[col].dtype != np.int32:
+                df[col] = df[col].fillna(MISSING_OFFSET).astype(np.int32)
+    return df
+
+
+def section_text(df, name):
+    """Text of one section of each report, None where the report lacks it"""
+    starts = df[name + START_SUFFIX].to_numpy()
+    ends = df[name + END_SUFFIX].to_numpy()
+    if name + TEXT_SUFFIX in df.columns:
+        texts = [t if isinstance(t, str) else None for t in df[name + TEXT_SUFFIX]]
+    else:
+        texts = [None] * len(df)
+    return pd.Series(
+        [
+            narrative[start:end] if start != MISSING_OFFSET else text
+            for narrative, start, end, text in zip(df["Narrative"], starts, ends, texts)
+        ],
+        index=df.index,
+    )
+
+
+def expand_section_columns(df):
+    """Replace the section offsets with a text column per section"""
+    names = section_names(df)
+    texts = {name: section_text(df, name) for name in names}
+    df = df.drop(
+        columns=[
+            name + suffix
+            for name in names
+            for suffix in [START_SUFFIX, END_SUFFIX, TEXT_SUFFIX]
+            if name + suffix in df.columns
+        ]
+    )
+    return pd.concat([df, pd.DataFrame(texts, index=df.index)], axis=1)
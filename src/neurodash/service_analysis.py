@@ -13,6 +13,7 @@ import streamlit as st
 
 pd.set_option("display.max_columns", 10)
 pd.set_option("display.width", 1000)
+from neurodash.domains import PATHOLOGICAL_DOMAINS, expand_domain_columns
 from neurodash.utils import df_to_json, generate_service_report_pdf
 
 sns.set_style("ticks")
@@ -25,25 +26,6 @@ plt.rcParams["legend.title_fontsize"] = FONTSIZE
 plt.rcParams["xtick.labelsize"] = FONTSIZE
 plt.rcParams["ytick.labelsize"] = FONTSIZE
 
-PATHOLOGICAL_DOMAINS = [
-    "Interventional - Surgery",
-    "Cerebrovascular",
-    "Neoplastic & paraneoplastic",
-    "Epilepsy",
-    "Infectious",
-    "Haematological",
-    "Metabolic, Nutritional, & Toxic",
-    "CSF disorders",
-    "Ophthalmological",
-    "Headache",
-    "Endocrine",
-    "Inflammatory & Autoimmune",
-    "Neurodegenerative & Dementia",
-    "Congenital & Developmental",
-    "Traumatic",
-    "Musculoskeletal",
-]
-
 
 def load_input(data_file):
     """load in data or take input from stdin"""
@@ -85,6 +67,7 @@ def transform_data(data):
         )
         .assign(date=lambda x: x["End Exam Date"].dt.date)
         .pipe(split_reporters)
+        .pipe(expand_domain_columns, keep_names=False)
     )
     return transformed_data
 
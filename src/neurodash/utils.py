@@ -4,13 +4,22 @@ import base64
 import io
 import json
 import os
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from importlib.util import find_spec
 from pathlib import Path
 
 import msoffcrypto
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import streamlit as st
 from neuradicon.custom_pipes import *
+from pandas.api.types import union_categoricals
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.lib.styles import ParagraphStyle
@@ -18,46 +27,56 @@ from reportlab.lib.units import cm
 from reportlab.platypus import (Image, Paragraph, SimpleDocTemplate, Spacer,
                                 Table, TableStyle)
 
-from neurodash.inference import DashboardInferenceEngine
+from neurodash.cleaning import clean_narratives
+from neurodash.domains import domains_present
+from neurodash.inference import MAX_ENRICHED_REPORTS, DashboardInferenceEngine
+from neurodash.sections import END_SUFFIX, MISSING_OFFSET, START_SUFFIX
 
+# uploaded files read concurrently by read_file_input
+MAX_FILES_IN_FLIGHT = 4
+# the Rust calamine reader is much faster than openpyxl, but optional
+XLSX_ENGINE = "calamine" if find_spec("python_calamine") else "openpyxl"
+XLSX_ESCAPE_PATTERN = re.compile(r"_x([0-9A-Fa-f]{4})_")
+# date format of RIS exports, unless a column's config gives its own
+DEFAULT_DATE_FORMAT = "%d/%m/%Y %H:%M"
+# text columns are kept in Arrow memory rather than as Python objects
+ARROW_STRING = pd.StringDtype("pyarrow")
 
-def process_ris_df(report_df, data_format):
+
+def process_ris_df(report_df, data_format, n_workers=1):
     """Preprocess RIS-format CSV file into Pandas dataframe
 
-    RIS CSV format from NHNN database, format from period 2018-10-28_to_2019-04-01
+    RIS CSV format from NHNN database, format from period 2018-10-28_to_2019-04-01.
+    Narratives are cleaned across `n_workers` processes when above 1.
     """
 
-    required_columns = [
-        key for key, vals in data_format.items() if not vals["inferred"]
-    ]
+    required_columns = ris_columns(data_format)
 
     if not all([name in report_df.columns for name in required_columns]):
         raise Exception(
             f"This CSV does not all have the required columns for RIS format. Required columns are {required_columns}"
         )
-    report_df["Narrative"] = report_df["Narrative"].str.replace(
-        r"\\\w+|\{.*?\}|}", "", regex=True
-    )
-    report_df["Narrative"] = report_df["Narrative"].str.replace(
-        r"(\n+)", " ", regex=True
-    )
-    report_df["Narrative"] = report_df["Narrative"].str.replace(
-        r"(\r+)", " ", regex=True
-    )
-    report_df["Narrative"] = report_df["Narrative"].str.replace(" .", ".", regex=False)
-    report_df["Narrative"] = report_df["Narrative"].str.replace(
-        r"_\S+_", "", regex=True
-    )
-    report_df["Narrative"] = report_df["Narrative"].str.replace(
-        r"\s{2,}", " ", regex=True
-    )
-    report_df["Narrative"] = report_df["Narrative"].str.strip()
+    report_df["Narrative"] = clean_narratives(report_df["Narrative"], n_workers)
     return report_df
 
 
 @st.cache_resource
-def model_factory(inference_models):
-    return DashboardInferenceEngine(inference_models)
+def model_factory(
+    inference_models,
+    cache_path=None,
+    n_workers=1,
+    contrast_markers=None,
+    doc_store_path=None,
+    max_enriched_reports=MAX_ENRICHED_REPORTS,
+):
+    return DashboardInferenceEngine(
+        inference_models,
+        cache_path=cache_path,
+        n_workers=n_workers,
+        contrast_markers=contrast_markers,
+        doc_store_path=doc_store_path,
+        max_enriched_reports=max_enriched_reports,
+    )
 
 
 def replace_normality_labels(df):
@@ -84,7 +103,8 @@ def load_pipeline(name):
 
 def get_multiselect_options(pd_series, max_n_cats=30):
     """utility to get available options for multiselectbox"""
-    options = pd_series.value_counts().index[:max_n_cats].tolist()
+    counts = pd_series.value_counts()
+    options = counts[counts > 0].index[:max_n_cats].tolist()
     options.append("all")
     try:
         options = sorted(options)
@@ -94,8 +114,8 @@ def get_multiselect_options(pd_series, max_n_cats=30):
 
 
 def get_multilabel_select_options(pd_series):
-    options = (d for doc in pd_series.tolist() for d in doc)
-    options = list(set(options))
+    """utility to get available options for a bitmask-encoded domain column"""
+    options = domains_present(pd_series)
     options.append("all")
     try:
         options = sorted(options)
@@ -367,8 +387,12 @@ def identify_filetype(filename):
         return "csv"
     elif filename[-4:] == "xlsx":
         return "xlsx"
+    elif filename[-7:] == "parquet":
+        return "parquet"
     else:
-        raise Exception("Filetype not supported, supported filetypes: .xlsx, .csv")
+        raise Exception(
+            "Filetype not supported, supported filetypes: .xlsx, .csv, .parquet"
+        )
 
 
 def convert_df(df):
@@ -390,51 +414,348 @@ def check_file_encryption(file_list):
     return encryption_list
 
 
-@st.cache_data()
-def decrypt_files(file_list, encryption_status, password):
-    output_file_tuples = []
-    for file_tuple, encrypted in zip(file_list, encryption_status):
-        filename, file = file_tuple
+def decrypt_files(file_list, encryption_status, password, decrypt_cache):
+    """Decrypt the password protected workbooks of an upload
+
+    Decrypted files are spilled to, and reused from, `decrypt_cache`.
+    Workbooks are decrypted one at a time, as most of the time goes on
+    msoffcrypto's password hashing, which holds the GIL.
+    """
+    decrypted_list = []
+    for (filename, file), encrypted in zip(file_list, encryption_status):
         if encrypted:
-            decrypted_file = decrypt_xlsx(file, password)
-            output_file_tuples.append((filename, decrypted_file))
-        else:
-            output_file_tuples.append((filename, file))
-    return output_file_tuples
+            try:
+                file = decrypt_cache.decrypt(file, password, decrypt_xlsx)
+            except msoffcrypto.exceptions.InvalidKeyError:
+                raise Exception(f"Incorrect password for {filename}")
+        decrypted_list.append((filename, file))
+    return decrypted_list
+
+
+def read_report_file(name, f, data_format):
+    """Read and clean one RIS export, or read an enriched Parquet file"""
+    file_type = identify_filetype(name)
+    if file_type == "parquet":
+        return read_enriched_parquet(f)
+    if file_type == "xlsx":
+        ris_df = read_ris_xlsx(f, data_format)
 
+    else:
+        ris_df = read_ris_csv(f, data_format)
 
-def read_file_input(file_list, data_format):
-    report_dfs = []
-    date_columns, data_types = derive_columns(data_format)
-    for name, f in file_list:
-        file_type = identify_filetype(name)
-        if file_type == "xlsx":
-            ris_df = pd.read_excel(
-                f,
-                parse_dates=date_columns,
-                index_col=False,
-                engine="openpyxl",
-                dtype=data_types,
+    return process_ris_df(ris_df, data_format)
+
+
+def read_ris_xlsx(f, data_format, engine=None):
+    """Read a RIS XLSX export, with calamine if it is installed, else openpyxl
+
+    `f` can be an uploaded file or the BytesIO returned by `decrypt_xlsx`.
+    """
+    _, data_types = derive_columns(data_format)
+    columns = ris_columns(data_format)
+    engine = engine or XLSX_ENGINE
+    f.seek(0)
+    ris_df = pd.read_excel(
+        f,
+        usecols=lambda c: c in columns,
+        index_col=False,
+        engine=engine,
+        dtype=data_types,
+    )
+    if engine == "openpyxl":
+        ris_df = unescape_xlsx_text(ris_df)
+    return parse_date_columns(ris_df, data_format)
+
+
+def _unescape_xlsx_char(match):
+    return chr(int(match.group(1), 16))
+
+
+def unescape_xlsx_text(df):
+    """Decode the _xHHHH_ escapes of control characters, e.g. _x000D_ for \\r
+
+    calamine decodes them, openpyxl leaves them in the text. Arrow can't
+    replace with a function, so text is decoded as Python strings.
+    """
+    for key in df.columns:
+        dtype = df[key].dtype
+        if dtype == ARROW_STRING or isinstance(dtype, pd.CategoricalDtype):
+            df[key] = (
+                df[key]
+                .astype(object)
+                .str.replace(XLSX_ESCAPE_PATTERN, _unescape_xlsx_char, regex=True)
+                .astype(dtype if dtype == ARROW_STRING else "category")
             )
+    return df
 
-        else:
-            ris_df = pd.read_csv(
-                f,
-                low_memory=False,
-                parse_dates=date_columns,
-                dayfirst=True,
-                index_col=False,
-                dtype=data_types,
+
+def ris_columns(data_format):
+    """The columns read from a RIS export, rather than inferred"""
+    return [key for key, vals in data_format.items() if not vals["inferred"]]
+
+
+def arrow_csv_options(data_format):
+    """Arrow CSV conversion options reading only the configured RIS columns
+
+    Dates are read as text, to be parsed by `parse_date_columns`.
+    """
+    str2type = {
+        "string": pa.string(),
+        "category": pa.dictionary(pa.int32(), pa.string()),
+        "date": pa.string(),
+        "boolean": pa.bool_(),
+        "integer": pa.int64(),
+    }
+    columns = ris_columns(data_format)
+    return pa_csv.ConvertOptions(
+        include_columns=columns,
+        column_types={key: str2type[data_format[key]["dtype"]] for key in columns},
+        strings_can_be_null=True,
+    )
+
+
+def categorize_columns(df, data_format):
+    """Convert the columns configured with the category dtype to Categoricals"""
+    for key, vals in data_format.items():
+        if vals["dtype"] == "category" and key in df.columns:
+            df[key] = df[key].astype("category")
+    return df
+
+
+def concat_reports(report_dfs, data_format):
+    """Concatenate report dataframes, keeping category columns categorical
+
+    Each frame holds only the categories it has seen, so their categories
+    are unified first; otherwise pandas would fall back to object columns.
+    """
+    report_dfs = [categorize_columns(df, data_format) for df in report_dfs]
+    for key, vals in data_format.items():
+        columns = [df[key] for df in report_dfs if key in df.columns]
+        if vals["dtype"] != "category" or not columns:
+            continue
+        dtype = pd.CategoricalDtype(
+            union_categoricals(columns, ignore_order=True).categories
+        )
+        for df in report_dfs:
+            if key in df.columns:
+                df[key] = df[key].astype(dtype)
+    return pd.concat(report_dfs, ignore_index=True)
+
+
+def parse_date_columns(df, data_format):
+    """Parse date columns with their configured `date_format`
+
+    Columns not matching the format fall back to inferring it, day first,
+    and are left as text if that fails too.
+    """
+    for key, vals in data_format.items():
+        if vals["dtype"] != "date" or key not in df.columns:
+            continue
+        date_format = vals.get("date_format", DEFAULT_DATE_FORMAT)
+        try:
+            df[key] = pd.to_datetime(df[key], format=date_format)
+        except (ValueError, TypeError):
+            print(f"{key} does not match the date format {date_format}, inferring it")
+            try:
+                df[key] = pd.to_datetime(df[key], dayfirst=True)
+            except (ValueError, TypeError):
+                pass
+    return df
+
+
+def arrow_to_ris_df(table, data_format):
+    df = table.to_pandas(types_mapper={pa.string(): ARROW_STRING}.get)
+    return parse_date_columns(df, data_format)
+
+
+def iter_row_chunks(reader, chunk_size):
+    """Regroup the record batches of a streaming reader into tables of `chunk_size` rows"""
+    batches, n_rows = [], 0
+    for batch in reader:
+        batches.append(batch)
+        n_rows += batch.num_rows
+        while n_rows >= chunk_size:
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            yield table.slice(0, chunk_size)
+            rest = table.slice(chunk_size)
+            batches, n_rows = rest.to_batches(), rest.num_rows
+    if n_rows:
+        yield pa.Table.from_batches(batches, schema=reader.schema)
+
+
+def read_ris_csv(f, data_format, chunk_size=None):
+    """Read a RIS CSV export, as an iterator of chunks if `chunk_size` is given
+
+    Only the configured columns are read, by Arrow's multithreaded CSV
+    parser, and text is kept in Arrow-backed string columns.
+    """
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    convert_options = arrow_csv_options(data_format)
+    try:
+        if chunk_size is None:
+            table = pa_csv.read_csv(
+                f, parse_options=parse_options, convert_options=convert_options
             )
+            return arrow_to_ris_df(table, data_format)
+        reader = pa_csv.open_csv(
+            f, parse_options=parse_options, convert_options=convert_options
+        )
+    except pa.ArrowKeyError:
+        raise Exception(
+            f"This CSV does not all have the required columns for RIS format. Required columns are {ris_columns(data_format)}"
+        )
+    return (
+        arrow_to_ris_df(table, data_format)
+        for table in iter_row_chunks(reader, chunk_size)
+    )
+
+
+def iter_report_file_chunks(name, f, data_format, chunk_size):
+    """Read and clean one file in chunks of at most `chunk_size` reports
+
+    CSV exports and Parquet files are streamed, so only one chunk is held
+    in memory. Workbooks can only be read whole, then are cut into chunks.
+    """
+    file_type = identify_filetype(name)
+    if file_type == "csv":
+        for ris_df in read_ris_csv(f, data_format, chunk_size):
+            yield process_ris_df(ris_df, data_format)
+    elif file_type == "parquet":
+        parquet_file = pq.ParquetFile(f)
+        inferred = enriched_parquet_inferred(parquet_file.schema_arrow)
+        for batch in parquet_file.iter_batches(batch_size=chunk_size):
+            df = pa.Table.from_batches([batch]).to_pandas()
+            df.attrs["inferred"] = inferred
+            yield df
+    else:
+        df = read_report_file(name, f, data_format)
+        for start in range(0, len(df), chunk_size):
+            yield df.iloc[start : start + chunk_size].reset_index(drop=True)
 
-        df = process_ris_df(ris_df, data_format)
-        report_dfs.append(df)
+
+def iter_file_input(file_list, data_format, chunk_size=5000):
+    """Read uploaded files one chunk of reports at a time, in the order given"""
+    for name, f in file_list:
+        yield from iter_report_file_chunks(name, f, data_format, chunk_size)
+
+
+def read_file_input(file_list, data_format, max_files_in_flight=MAX_FILES_IN_FLIGHT):
+    """Read uploaded files into report dataframes, in the order given
+
+    Files are read concurrently on a thread pool, with at most
+    `max_files_in_flight` read but not yet collected at any time.
+    """
+    report_dfs = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_files_in_flight) as pool:
+        for name, f in file_list:
+            if len(pending) >= max_files_in_flight:
+                report_dfs.append(pending.popleft().result())
+            pending.append(pool.submit(read_report_file, name, f, data_format))
+        while pending:
+            report_dfs.append(pending.popleft().result())
     return report_dfs
 
 
+def write_enriched_parquet(df, path, inferred_columns):
+    """Write an enriched report dataframe, recording which columns were inferred"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = {
+        **(table.schema.metadata or {}),
+        b"neurodash_inferred": json.dumps(inferred_columns).encode("utf-8"),
+    }
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+
+
+def read_enriched_parquet(f):
+    """Read an enriched report dataframe
+
+    The inferred columns it holds are listed in `df.attrs["inferred"]`.
+    """
+    table = pq.read_table(f)
+    df = table.to_pandas()
+    df.attrs["inferred"] = enriched_parquet_inferred(table.schema)
+    return df
+
+
+def enriched_parquet_inferred(schema):
+    """The inferred columns recorded in an enriched Parquet schema"""
+    return json.loads((schema.metadata or {}).get(b"neurodash_inferred", b"[]"))
+
+
+def _conform_table(table, schema):
+    """Cast a table to `schema`, adding the columns it lacks
+
+    Missing section offsets are filled with -1, other missing columns with nulls.
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table[field.name].cast(field.type))
+        elif field.name.endswith((START_SUFFIX, END_SUFFIX)) and pa.types.is_integer(
+            field.type
+        ):
+            columns.append(pa.array([MISSING_OFFSET] * len(table), type=field.type))
+        else:
+            columns.append(pa.nulls(len(table), type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _merged_pandas_metadata(schemas):
+    """Pandas metadata describing the columns of every part"""
+    metadata = None
+    for schema in schemas:
+        part = json.loads(schema.metadata[b"pandas"])
+        if metadata is None:
+            metadata = part
+            continue
+        names = {c["name"] for c in metadata["columns"]}
+        metadata["columns"] += [c for c in part["columns"] if c["name"] not in names]
+    return json.dumps(metadata).encode("utf-8")
+
+
+def write_enriched_parquet_chunks(chunks, path, inferred_columns):
+    """Write enriched report chunks to one Parquet file as they are produced
+
+    Each chunk is spooled to a part file next to `path`, then the parts are
+    merged under a schema holding the columns of all of them, so no more
+    than one chunk is in memory at a time. Returns the number of reports.
+    """
+    path = Path(path)
+    n_reports = 0
+    with tempfile.TemporaryDirectory(dir=path.parent, prefix=f".{path.name}.") as tmp:
+        part_paths = []
+        for i, chunk in enumerate(chunks):
+            part_paths.append(Path(tmp) / f"part-{i:05d}.parquet")
+            pq.write_table(
+                pa.Table.from_pandas(chunk, preserve_index=False), part_paths[-1]
+            )
+            n_reports += len(chunk)
+        if not part_paths:
+            raise Exception(f"No reports to write to {path}")
+        schemas = [pq.read_schema(p) for p in part_paths]
+        schema = pa.unify_schemas(schemas, promote_options="permissive")
+        schema = schema.with_metadata(
+            {
+                b"pandas": _merged_pandas_metadata(schemas),
+                b"neurodash_inferred": json.dumps(inferred_columns).encode("utf-8"),
+            }
+        )
+        with pq.ParquetWriter(path, schema) as writer:
+            for part_path in part_paths:
+                writer.write_table(_conform_table(pq.read_table(part_path), schema))
+    return n_reports
+
+
 def derive_columns(data_format):
     date_columns = [key for key, vals in data_format.items() if vals["dtype"] == "date"]
-    str2type = {"string": str, "boolean": bool, "integer": int, "list": list}
+    str2type = {
+        "string": ARROW_STRING,
+        "category": "category",
+        "boolean": bool,
+        "integer": int,
+        "list": list,
+    }
     data_types = {
         key: str2type[vals["dtype"]]
         for key, vals in data_format.items()
@@ -443,10 +764,11 @@ def derive_columns(data_format):
     return date_columns, data_types
 
 
-def decrypt_xlsx(file_bytes, password):
+def decrypt_xlsx(file_bytes, password, decrypted=None):
+    """Decrypt a workbook into `decrypted`, a new BytesIO unless given"""
     office_file = msoffcrypto.OfficeFile(file_bytes)
-    decrypted = io.BytesIO()
-    office_file.load_key(password=password)
+    decrypted = io.BytesIO() if decrypted is None else decrypted
+    office_file.load_key(password=password, verify_password=True)
     office_file.decrypt(decrypted)
     return decrypted
 
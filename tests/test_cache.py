@@ -0,0 +1,27 @@
+from neurodash.cache import DocStore, InferenceCache
+
+
+def test_inference_cache_prunes_the_oldest_rows(tmp_path):
+    cache = InferenceCache(tmp_path / "cache.sqlite", max_rows=10)
+    hashes = [str(i) for i in range(10)]
+    cache.set(hashes, "normality_class", "m", hashes)
+    cache.set(["0"], "normality_class", "m", ["rewritten"])
+    assert len(cache) == 10
+    cache.set(["10"], "normality_class", "m", ["10"])
+    # pruned to nine tenths of the bound, oldest written first
+    assert len(cache) == 9
+    assert cache.get(["0", "1", "2", "3"], "normality_class", "m") == {
+        "0": "rewritten",
+        "3": "3",
+    }
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_doc_store_prunes_the_oldest_docs(tmp_path):
+    store = DocStore(tmp_path / "docs.sqlite", max_rows=1)
+    store.set(["a"], "m", [b"doc a"])
+    store.set(["b"], "m", [b"doc b"])
+    assert len(store) == 1
+    assert store.get("a", "m") is None
+    assert store.get("b", "m") == b"doc b"
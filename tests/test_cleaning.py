@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from neurodash import cleaning
+
+EDGE_CASES = [
+    np.nan,
+    None,
+    "",
+    "   ",
+    "{\\rtf1\\ansi}",
+    "No abnormality .",
+    "word .word",
+    "\n\r.",
+    "\r\n .",
+    "a\n\n\nb\r\r\rc",
+    "_x000D_ trailing",
+    "in_line_ escapes _a_b_",
+    "{nested {groups}} remain}",
+    "unclosed {group\nacross lines}",
+    "\\par\\pard plain \\b bold\\b0",
+    "tabs\tand non-breaking spaces",
+    " . . leading and trailing . ",
+    "{\\rtf1\\ansi {\\fonttbl\\f0 Arial;}\\par MRI HEAD\\par\r\n"
+    "Findings: No acute infarct .\n\nConclusion: Normal study . }",
+]
+
+
+def reference_clean(narratives):
+    """The cleaning passes of `process_ris_df` before the fused engine"""
+    narratives = narratives.str.replace(r"\\\w+|\{.*?\}|}", "", regex=True)
+    narratives = narratives.str.replace(r"(\n+)", " ", regex=True)
+    narratives = narratives.str.replace(r"(\r+)", " ", regex=True)
+    narratives = narratives.str.replace(" .", ".", regex=False)
+    narratives = narratives.str.replace(r"_\S+_", "", regex=True)
+    narratives = narratives.str.replace(r"\s{2,}", " ", regex=True)
+    return narratives.str.strip()
+
+
+@pytest.fixture
+def narratives():
+    return pd.Series(EDGE_CASES, dtype=object, name="Narrative")
+
+
+def test_clean_narratives_matches_the_original_rules(narratives):
+    pd.testing.assert_series_equal(
+        cleaning.clean_narratives(narratives), reference_clean(narratives)
+    )
+
+
+def test_clean_narratives_in_parallel(narratives, monkeypatch):
+    monkeypatch.setattr(cleaning, "CLEANING_CHUNK_SIZE", 4)
+    pd.testing.assert_series_equal(
+        cleaning.clean_narratives(narratives, n_workers=2), reference_clean(narratives)
+    )
@@ -0,0 +1,40 @@
+import pandas as pd
+import pytest
+
+from neurodash.contrast import DEFAULT_CONTRAST_MARKERS, uses_contrast
+
+
+@pytest.fixture(params=[object, "string[pyarrow]"])
+def reports(request):
+    return pd.DataFrame(
+        {
+            "Procedure": ["MR Head", "MR Head +C", "CT Head", None],
+            "Narrative": [
+                "No abnormality.",
+                "Pre and post contrast imaging.",
+                "Images POST GADOLINIUM show enhancement.",
+                None,
+            ],
+        },
+        dtype=request.param,
+    )
+
+
+def test_uses_contrast(reports):
+    flags = uses_contrast(reports, DEFAULT_CONTRAST_MARKERS)
+    assert flags.dtype == bool
+    assert flags.tolist() == [False, True, True, False]
+
+
+def test_markers_are_matched_literally(reports):
+    assert uses_contrast(reports, {"Procedure": ["+c"]}).tolist() == [
+        False,
+        True,
+        False,
+        False,
+    ]
+
+
+def test_columns_without_markers_are_not_searched(reports):
+    assert not uses_contrast(reports, {"Narrative": []}).any()
+    assert not uses_contrast(reports, {"Narrative": [""]}).any()
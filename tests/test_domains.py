@@ -0,0 +1,23 @@
+import logging
+
+import numpy as np
+
+from neurodash import domains
+
+
+def test_encode_domains_round_trips():
+    domain_lists = [
+        [],
+        ["Epilepsy"],
+        ["Cerebrovascular", domains.PATHOLOGICAL_DOMAINS[-1]],
+    ]
+    masks = domains.encode_domains(domain_lists)
+    assert masks.dtype == np.uint32
+    assert [domains.decode_domains(m) for m in masks] == domain_lists
+
+
+def test_unknown_domains_are_dropped_with_a_warning(caplog):
+    with caplog.at_level(logging.WARNING, logger="neurodash.domains"):
+        masks = domains.encode_domains([["Epilepsy", "Not a domain"], ["Not a domain"]])
+    assert masks.tolist() == [domains.DOMAIN_BITS["Epilepsy"], 0]
+    assert "Not a domain" in caplog.text
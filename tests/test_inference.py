@@ -0,0 +1,35 @@
+import spacy
+
+from neurodash import inference
+
+
+def save_pipeline(path, special_case=None):
+    nlp = spacy.blank("en")
+    if special_case is not None:
+        nlp.tokenizer.add_special_case(special_case, [{"ORTH": special_case}])
+    nlp.to_disk(path)
+    return str(path)
+
+
+def test_saved_tokenizer_signature_matches_the_loaded_pipeline(tmp_path):
+    path = save_pipeline(tmp_path / "model", special_case="MR+c")
+    assert inference.saved_tokenizer_signature(path)[
+        -1
+    ] == inference.tokenizer_signature(spacy.load(path))
+    assert inference.saved_tokenizer_signature("en_core_web_sm") is None
+
+
+def test_shares_tokenizer_without_loading_saved_pipelines(tmp_path):
+    model_paths = {
+        "tokenizer": save_pipeline(tmp_path / "tokenizer"),
+        "normality_cls": save_pipeline(tmp_path / "normality"),
+        "comparative_cls": save_pipeline(tmp_path / "comparative", "MR+c"),
+    }
+    engine = inference.DashboardInferenceEngine(model_paths)
+    assert engine.shares_tokenizer("normality_cls")
+    assert not engine.shares_tokenizer("comparative_cls")
+    assert not any(
+        path in key
+        for key in inference.MODEL_LOAD_STATS
+        for path in model_paths.values()
+    )